@@ -33,19 +33,33 @@
 import os
 import sys
 import math
+import struct
+import hmac
+import threading
+import collections
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, without it the T-table implementation is used for all blocks
+    numpy = None
 
 def append_PKCS7_padding(s):
-    """return s padded to a multiple of 16-bytes by PKCS7 padding"""
+    """return s padded to a multiple of 16-bytes by PKCS7 padding (s is a string or bytes)"""
     numpads = 16 - (len(s)%16)
-    return s + numpads*chr(numpads)
+    if isinstance(s, str):
+        return s + numpads*chr(numpads)
+    return bytes(s) + numpads*bytes([numpads])
 
 def strip_PKCS7_padding(s):
-    """return s stripped of PKCS7 padding"""
+    """return s stripped of PKCS7 padding (s is a string or bytes)"""
     if len(s)%16 or not s:
         raise ValueError("String of len %d can't be PCKS7-padded" % len(s))
-    numpads = ord(s[-1])
-    if numpads > 16:
+    numpads = ord(s[-1]) if isinstance(s, str) else s[-1]
+    if numpads > 16 or numpads == 0:
         raise ValueError("String ending with %r can't be PCKS7-padded" % s[-1])
+    padding = s[-numpads:]
+    if padding != (numpads*chr(numpads) if isinstance(s, str) else numpads*bytes([numpads])):
+        raise ValueError("String ending with %r has invalid PKCS7 padding" % padding)
     return s[:-numpads]
 
 class AES(object):
@@ -339,6 +353,28 @@ class AES(object):
         state = self.addRoundKey(state, self.createRoundKey(expandedKey, 0))
         return state
 
+    # Same as aes_main, but with the round keys already created (see AESKey)
+    def aes_mainRoundKeys(self, state, roundKeys):
+        nbrRounds = len(roundKeys) - 1
+        state = self.addRoundKey(state, roundKeys[0])
+        for i in range(1, nbrRounds):
+            state = self.aes_round(state, roundKeys[i])
+        state = self.subBytes(state, False)
+        state = self.shiftRows(state, False)
+        state = self.addRoundKey(state, roundKeys[nbrRounds])
+        return state
+
+    # Same as aes_invMain, but with the round keys already created (see AESKey)
+    def aes_invMainRoundKeys(self, state, roundKeys):
+        nbrRounds = len(roundKeys) - 1
+        state = self.addRoundKey(state, roundKeys[nbrRounds])
+        for i in range(nbrRounds - 1, 0, -1):
+            state = self.aes_invRound(state, roundKeys[i])
+        state = self.shiftRows(state, True)
+        state = self.subBytes(state, True)
+        state = self.addRoundKey(state, roundKeys[0])
+        return state
+
     # encrypts a 128 bit input block against the given key of size specified
     def _encrypt(self, iput, key, size):
         output = [0] * 16
@@ -422,21 +458,641 @@ class AES(object):
         return output
         
     def encrypt(self, iput, key, size):
-        key = list(key)
         iput = list(iput)
         if len(iput) != 16:
             raise ValueError("block size incorrect in encrypt input")
-        result = self._encrypt(iput, key, size)
-        return bytes(result)
+        # the expanded key is taken from the key cache
+        return self.encryptBlock(iput, getAESKey(key, size))
     
     def decrypt(self, iput, key, size):
-        key = list(key)
         iput = list(iput)
-        result = self._decrypt(iput,key,size)
-        return bytes(result)
+        return self.decryptBlock(iput, getAESKey(key, size))
+
+    def encryptBlock(self, iput, aesKey):
+        """Encrypts one 16 byte block with an AESKey, without expanding the key again"""
+        if len(iput) != 16:
+            raise ValueError("block size incorrect in encrypt input")
+        # same mapping of the input to the state as in _encrypt
+        block = [iput[(i % 4)*4 + i//4] for i in range(16)]
+        block = self.aes_mainRoundKeys(block, aesKey.roundKeys)
+        return bytes(block[(i % 4)*4 + i//4] for i in range(16))
+
+    def encrypt_blocks(self, buf, key, size, out=None):
+        """Encrypts a buffer of any number of 16 byte blocks (ECB), see AESKey.encrypt_blocks"""
+        return getAESKey(key, size).encrypt_blocks(buf, out)
+
+    def decrypt_blocks(self, buf, key, size, out=None):
+        """Decrypts a buffer of any number of 16 byte blocks (ECB), see AESKey.decrypt_blocks"""
+        return getAESKey(key, size).decrypt_blocks(buf, out)
+
+    def decryptBlock(self, iput, aesKey):
+        """Decrypts one 16 byte block with an AESKey, without expanding the key again"""
+        if len(iput) != 16:
+            raise ValueError("block size incorrect in decrypt input")
+        block = [iput[(i % 4)*4 + i//4] for i in range(16)]
+        block = self.aes_invMainRoundKeys(block, aesKey.roundKeys)
+        return bytes(block[(i % 4)*4 + i//4] for i in range(16))
+
+#
+# T-table implementation of AES.
+#
+# The reference implementation above follows the textbook description: every round applies
+# subBytes, shiftRows, mixColumns and addRoundKey to a list of 16 bytes, and mixColumns does
+# 16 bit-by-bit galois multiplications per column.
+# Since subBytes, shiftRows and mixColumns are all fixed for a given input byte, they can be
+# combined into four lookup tables of 256 32-bit words (Te0..Te3 for encryption and Td0..Td3
+# for decryption). The state is then kept as four column words and one round becomes 16 table
+# lookups and 16 XORs. The output is identical to the reference implementation.
+#
+def _buildTables():
+    """Builds the encryption (Te0..Te3) and decryption (Td0..Td3) T-tables"""
+    g = AES().galois_multiplication
+    Te = [[0] * 256 for i in range(4)]
+    Td = [[0] * 256 for i in range(4)]
+    for x in range(256):
+        s = AES.sbox[x]
+        # one column of mixColumns applied to (s, 0, 0, 0)
+        w = (g(s, 2) << 24) | (s << 16) | (s << 8) | g(s, 3)
+        r = AES.rsbox[x]
+        # one column of the inverse mixColumns applied to (r, 0, 0, 0)
+        v = (g(r, 14) << 24) | (g(r, 9) << 16) | (g(r, 13) << 8) | g(r, 11)
+        for i in range(4):
+            # table i is table 0 rotated i bytes to the right
+            Te[i][x] = ((w >> (8*i)) | (w << (32 - 8*i))) & 0xffffffff
+            Td[i][x] = ((v >> (8*i)) | (v << (32 - 8*i))) & 0xffffffff
+    return Te, Td
+
+(Te0, Te1, Te2, Te3), (Td0, Td1, Td2, Td3) = _buildTables()
+
+def _encryptWords(s0, s1, s2, s3, rk, nbrRounds):
+    """Encrypts one block given as 4 column words with the round key words rk"""
+    te0, te1, te2, te3, sbox = Te0, Te1, Te2, Te3, AES.sbox
+    s0 ^= rk[0]
+    s1 ^= rk[1]
+    s2 ^= rk[2]
+    s3 ^= rk[3]
+    k = 4
+    for r in range(nbrRounds - 1):
+        t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xff] ^ te2[(s2 >> 8) & 0xff] ^ te3[s3 & 0xff] ^ rk[k]
+        t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xff] ^ te2[(s3 >> 8) & 0xff] ^ te3[s0 & 0xff] ^ rk[k+1]
+        t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xff] ^ te2[(s0 >> 8) & 0xff] ^ te3[s1 & 0xff] ^ rk[k+2]
+        s3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xff] ^ te2[(s1 >> 8) & 0xff] ^ te3[s2 & 0xff] ^ rk[k+3]
+        s0, s1, s2 = t0, t1, t2
+        k += 4
+    # the final round has no mixColumns
+    return ((sbox[s0 >> 24] << 24 | sbox[(s1 >> 16) & 0xff] << 16 |
+             sbox[(s2 >> 8) & 0xff] << 8 | sbox[s3 & 0xff]) ^ rk[k],
+            (sbox[s1 >> 24] << 24 | sbox[(s2 >> 16) & 0xff] << 16 |
+             sbox[(s3 >> 8) & 0xff] << 8 | sbox[s0 & 0xff]) ^ rk[k+1],
+            (sbox[s2 >> 24] << 24 | sbox[(s3 >> 16) & 0xff] << 16 |
+             sbox[(s0 >> 8) & 0xff] << 8 | sbox[s1 & 0xff]) ^ rk[k+2],
+            (sbox[s3 >> 24] << 24 | sbox[(s0 >> 16) & 0xff] << 16 |
+             sbox[(s1 >> 8) & 0xff] << 8 | sbox[s2 & 0xff]) ^ rk[k+3])
+
+def _decryptWords(s0, s1, s2, s3, rk, nbrRounds):
+    """Decrypts one block given as 4 column words with the decryption round key words rk"""
+    td0, td1, td2, td3, rsbox = Td0, Td1, Td2, Td3, AES.rsbox
+    s0 ^= rk[0]
+    s1 ^= rk[1]
+    s2 ^= rk[2]
+    s3 ^= rk[3]
+    k = 4
+    for r in range(nbrRounds - 1):
+        t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xff] ^ td2[(s2 >> 8) & 0xff] ^ td3[s1 & 0xff] ^ rk[k]
+        t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xff] ^ td2[(s3 >> 8) & 0xff] ^ td3[s2 & 0xff] ^ rk[k+1]
+        t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xff] ^ td2[(s0 >> 8) & 0xff] ^ td3[s3 & 0xff] ^ rk[k+2]
+        s3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xff] ^ td2[(s1 >> 8) & 0xff] ^ td3[s0 & 0xff] ^ rk[k+3]
+        s0, s1, s2 = t0, t1, t2
+        k += 4
+    # the final round has no inverse mixColumns
+    return ((rsbox[s0 >> 24] << 24 | rsbox[(s3 >> 16) & 0xff] << 16 |
+             rsbox[(s2 >> 8) & 0xff] << 8 | rsbox[s1 & 0xff]) ^ rk[k],
+            (rsbox[s1 >> 24] << 24 | rsbox[(s0 >> 16) & 0xff] << 16 |
+             rsbox[(s3 >> 8) & 0xff] << 8 | rsbox[s2 & 0xff]) ^ rk[k+1],
+            (rsbox[s2 >> 24] << 24 | rsbox[(s1 >> 16) & 0xff] << 16 |
+             rsbox[(s0 >> 8) & 0xff] << 8 | rsbox[s3 & 0xff]) ^ rk[k+2],
+            (rsbox[s3 >> 24] << 24 | rsbox[(s2 >> 16) & 0xff] << 16 |
+             rsbox[(s1 >> 8) & 0xff] << 8 | rsbox[s0 & 0xff]) ^ rk[k+3])
+
+class TableAES(AES):
+    """AES using precomputed T-tables.
+
+    Same API as AES (encrypt/decrypt of exactly one 16 byte block), but the rounds
+    operate on 4 column words using the Te0..Te3 and Td0..Td3 tables.
+    """
+
+    def numberOfRounds(self, size):
+        """Returns the number of rounds for a key of size bytes, None for invalid sizes"""
+        if size == self.keySize["SIZE_128"]: return 10
+        elif size == self.keySize["SIZE_192"]: return 12
+        elif size == self.keySize["SIZE_256"]: return 14
+        return None
+
+    def tableKeySchedule(self, key, size, expandedKey=None):
+        """Expands the key into encryption and decryption round key words.
+
+        The encryption round keys are the expanded key taken 4 bytes at a time.
+        The decryption round keys are the encryption round keys in reverse order,
+        with the inverse mixColumns applied to all but the first and last one.
+        If the key is already expanded, the expanded key can be given.
+        """
+        nbrRounds = self.numberOfRounds(size)
+        if expandedKey is None:
+            expandedKey = self.expandKey(key, size, 16*(nbrRounds+1))
+        ek = [(expandedKey[i] << 24) | (expandedKey[i+1] << 16) |
+              (expandedKey[i+2] << 8) | expandedKey[i+3]
+              for i in range(0, len(expandedKey), 4)]
+        dk = []
+        sbox = self.sbox
+        for r in range(nbrRounds, -1, -1):
+            for w in ek[4*r:4*r+4]:
+                if 0 < r < nbrRounds:
+                    # Td[i][rsbox[x]] cancels the rsbox, leaving the inverse mixColumns
+                    w = (Td0[sbox[w >> 24]] ^ Td1[sbox[(w >> 16) & 0xff]] ^
+                         Td2[sbox[(w >> 8) & 0xff]] ^ Td3[sbox[w & 0xff]])
+                dk.append(w)
+        return ek, dk
+
+    def _encrypt(self, iput, key, size):
+        nbrRounds = self.numberOfRounds(size)
+        if nbrRounds is None: return None
+        ek, dk = self.tableKeySchedule(key, size)
+        words = _encryptWords(*struct.unpack('>4I', bytes(iput)), ek, nbrRounds)
+        return list(struct.pack('>4I', *words))
+
+    def _decrypt(self, iput, key, size):
+        nbrRounds = self.numberOfRounds(size)
+        if nbrRounds is None: return None
+        ek, dk = self.tableKeySchedule(key, size)
+        words = _decryptWords(*struct.unpack('>4I', bytes(iput)), dk, nbrRounds)
+        return list(struct.pack('>4I', *words))
+
+    def encrypt(self, iput, key, size):
+        return getAESKey(key, size).encrypt(iput)
+
+    def decrypt(self, iput, key, size):
+        return getAESKey(key, size).decrypt(iput)
+
+class AESKey(object):
+    """An AES key that is expanded only once.
+
+    AES.encrypt and AES.decrypt expand the key for every block they process.
+    An AESKey expands the key once and keeps the results, so it can be used to
+    encrypt or decrypt any number of blocks:
+    - expandedKey: the output of AES.expandKey
+    - roundKeys: the round keys as created by AES.createRoundKey, for the reference implementation
+    - encWords, decWords: the round keys as 32-bit words, for the T-table implementation
+    encrypt and decrypt use the T-table implementation.
+    """
+
+    def __init__(self, key, size=None):
+        key = list(key)
+        if size is None:
+            size = len(key)
+        table = TableAES()
+        self.size = size
+        self.nbrRounds = table.numberOfRounds(size)
+        if self.nbrRounds is None or len(key) < size:
+            raise ValueError("invalid key size: %s" % size)
+        key = key[:size]
+        self.expandedKey = table.expandKey(key, size, 16*(self.nbrRounds+1))
+        self.encWords, self.decWords = table.tableKeySchedule(key, size, self.expandedKey)
+        # created when the reference implementation uses this key for the first time
+        self._roundKeys = None
+        # created when the numpy engine is used for the first time
+        self._numpyRoundKeys = None
+        # created when this key is used for CMAC for the first time (see cmacSubkeys)
+        self.cmacSubkeys = None
+        # created when this key is used for GCM for the first time (see aesModeOfOperation.ghashTables)
+        self.ghashTables = None
+
+    @property
+    def roundKeys(self):
+        if self._roundKeys is None:
+            self._roundKeys = [AES().createRoundKey(self.expandedKey, 16*i)
+                               for i in range(self.nbrRounds+1)]
+        return self._roundKeys
+
+    def encryptWords(self, s0, s1, s2, s3):
+        """Encrypts one block given as 4 big endian 32-bit words, returns 4 words"""
+        return _encryptWords(s0, s1, s2, s3, self.encWords, self.nbrRounds)
+
+    def decryptWords(self, s0, s1, s2, s3):
+        """Decrypts one block given as 4 big endian 32-bit words, returns 4 words"""
+        return _decryptWords(s0, s1, s2, s3, self.decWords, self.nbrRounds)
+
+    def encrypt(self, iput):
+        """Encrypts exactly one 16 byte block, returns bytes"""
+        if len(iput) != 16:
+            raise ValueError("block size incorrect in encrypt input")
+        return struct.pack('>4I', *self.encryptWords(*struct.unpack('>4I', bytes(iput))))
+
+    def decrypt(self, iput):
+        """Decrypts exactly one 16 byte block, returns bytes"""
+        if len(iput) != 16:
+            raise ValueError("block size incorrect in decrypt input")
+        return struct.pack('>4I', *self.decryptWords(*struct.unpack('>4I', bytes(iput))))
+
+    def encrypt_blocks(self, buf, out=None):
+        """Encrypts all blocks of buf, which should be a multiple of 16 bytes long.
+
+        buf can be any bytes-like object (bytes, bytearray, memoryview, mmap, ...).
+        If out is given, the result is written into out (which may be buf itself)
+        and out is returned. Otherwise a new bytearray is returned.
+        """
+        if self._useNumpy(buf):
+            return _numpyProcessBlocks(_numpyEncrypt, self.numpyRoundKeys(), buf, out)
+        return _processBlocks(_encryptWords, self.encWords, self.nbrRounds, buf, out)
+
+    def decrypt_blocks(self, buf, out=None):
+        """Decrypts all blocks of buf, see encrypt_blocks"""
+        if self._useNumpy(buf):
+            return _numpyProcessBlocks(_numpyDecrypt, self.numpyRoundKeys(), buf, out)
+        return _processBlocks(_decryptWords, self.decWords, self.nbrRounds, buf, out)
+
+    def numpyRoundKeys(self):
+        """The round keys as an (Nr+1,16) numpy array, in the byte order of the blocks"""
+        if self._numpyRoundKeys is None:
+            self._numpyRoundKeys = numpy.array(self.expandedKey, dtype=numpy.uint8).reshape(-1, 16)
+        return self._numpyRoundKeys
+
+    def _useNumpy(self, buf):
+        return blockEngine == "numpy" and len(buf) >= 16 * NUMPY_MIN_BLOCKS
+
+# one block as 4 big endian 32-bit words
+_BLOCK = struct.Struct('>4I')
+
+#
+# Batched AES with numpy.
+#
+# When many independent blocks need to be encrypted (ECB, or the keystream of CTR), the
+# per-block Python overhead of the T-table implementation dominates.
+# With numpy, N blocks are kept as an (N,16) array of bytes and every step of a round is
+# applied to all blocks at once: subBytes is a table lookup (gather) in the S-box,
+# shiftRows is a permutation of the 16 columns of the array and mixColumns uses xtime
+# (multiplication by 2 in the Galois field) on whole arrays.
+#
+# Set blockEngine to "table" to disable the numpy engine, or use setBlockEngine.
+blockEngine = "numpy" if numpy is not None else "table"
+# below this number of blocks, the T-table implementation is faster
+NUMPY_MIN_BLOCKS = 16
+# the number of blocks processed at once by numpy, limits the size of temporary arrays
+NUMPY_CHUNK_BLOCKS = 65536
+
+def setBlockEngine(engine):
+    """Selects the engine for encrypt_blocks/decrypt_blocks: "numpy" or "table" """
+    global blockEngine
+    if engine not in ("numpy", "table"):
+        raise ValueError("unknown block engine: %s" % engine)
+    if engine == "numpy" and numpy is None:
+        raise ValueError("the numpy block engine requires numpy")
+    blockEngine = engine
+
+if numpy is not None:
+    _SBOX = numpy.array(AES.sbox, dtype=numpy.uint8)
+    _RSBOX = numpy.array(AES.rsbox, dtype=numpy.uint8)
+    # byte 4*c+r of the state is row r of column c
+    # shiftRows: row r is rotated r positions to the left
+    _SHIFT = numpy.array([4*((c + r) % 4) + r for c in range(4) for r in range(4)])
+    _INVSHIFT = numpy.array([4*((c - r) % 4) + r for c in range(4) for r in range(4)])
+
+def _xtime(a):
+    """Multiplies every byte of the uint8 array a by 2 in GF(2^8)"""
+    return (a << 1) ^ ((a >> 7) * numpy.uint8(0x1b))
+
+def _numpyMixColumns(state):
+    # state is an (N,16) array, viewed as (N,4,4): block, column, row
+    s = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = s[:, :, 0], s[:, :, 1], s[:, :, 2], s[:, :, 3]
+    t = a0 ^ a1 ^ a2 ^ a3
+    out = numpy.empty_like(s)
+    out[:, :, 0] = a0 ^ t ^ _xtime(a0 ^ a1)
+    out[:, :, 1] = a1 ^ t ^ _xtime(a1 ^ a2)
+    out[:, :, 2] = a2 ^ t ^ _xtime(a2 ^ a3)
+    out[:, :, 3] = a3 ^ t ^ _xtime(a3 ^ a0)
+    return out.reshape(-1, 16)
+
+def _numpyInvMixColumns(state):
+    # the inverse mixColumns is mixColumns after multiplying by (4x^2 + 5) mod (x^4 + 1)
+    s = state.reshape(-1, 4, 4).copy()
+    u = _xtime(_xtime(s[:, :, 0] ^ s[:, :, 2]))
+    v = _xtime(_xtime(s[:, :, 1] ^ s[:, :, 3]))
+    s[:, :, 0] ^= u
+    s[:, :, 1] ^= v
+    s[:, :, 2] ^= u
+    s[:, :, 3] ^= v
+    return _numpyMixColumns(s.reshape(-1, 16))
+
+def _numpyEncrypt(state, roundKeys):
+    """Encrypts an (N,16) uint8 array of blocks, roundKeys is an (Nr+1,16) uint8 array
+    (or an (Nr+1,N,16) array, with different round keys for every block)"""
+    nbrRounds = len(roundKeys) - 1
+    state = state ^ roundKeys[0]
+    for i in range(1, nbrRounds):
+        state = _numpyMixColumns(_SBOX[state][:, _SHIFT]) ^ roundKeys[i]
+    return _SBOX[state][:, _SHIFT] ^ roundKeys[nbrRounds]
+
+def _numpyDecrypt(state, roundKeys):
+    """Decrypts an (N,16) uint8 array of blocks, roundKeys is an (Nr+1,16) uint8 array"""
+    nbrRounds = len(roundKeys) - 1
+    state = state ^ roundKeys[nbrRounds]
+    for i in range(nbrRounds - 1, 0, -1):
+        state = _numpyInvMixColumns(_RSBOX[state[:, _INVSHIFT]] ^ roundKeys[i])
+    return _RSBOX[state[:, _INVSHIFT]] ^ roundKeys[0]
+
+def _numpyProcessBlocks(function, roundKeys, buf, out):
+    """Applies function (_numpyEncrypt or _numpyDecrypt) to every block of buf"""
+    with memoryview(buf) as view, view.cast('B') as src:
+        n = len(src)
+        if n % 16:
+            raise ValueError("input length %d is not a multiple of the block size" % n)
+        result = bytearray(n) if out is None else out
+        with memoryview(result) as resultView, resultView.cast('B') as dst:
+            if dst.readonly:
+                raise ValueError("output buffer is read-only")
+            if len(dst) < n:
+                raise ValueError("output buffer is too small: %d < %d" % (len(dst), n))
+            blocks = numpy.frombuffer(src, dtype=numpy.uint8).reshape(-1, 16)
+            target = numpy.frombuffer(dst, dtype=numpy.uint8)[:n].reshape(-1, 16)
+            for i in range(0, len(blocks), NUMPY_CHUNK_BLOCKS):
+                target[i:i+NUMPY_CHUNK_BLOCKS] = function(blocks[i:i+NUMPY_CHUNK_BLOCKS], roundKeys)
+            # the arrays refer to the buffers, drop them before the views are released
+            del blocks, target
+    return result
+
+def _processBlocks(function, rk, nbrRounds, buf, out):
+    """Applies function (_encryptWords or _decryptWords) to every block of buf.
+
+    The blocks are read from and written to the buffers directly, so no lists or
+    bytes objects are created per block.
+    """
+    with memoryview(buf) as view, view.cast('B') as src:
+        n = len(src)
+        if n % 16:
+            raise ValueError("input length %d is not a multiple of the block size" % n)
+        result = bytearray(n) if out is None else out
+        with memoryview(result) as resultView, resultView.cast('B') as dst:
+            if dst.readonly:
+                raise ValueError("output buffer is read-only")
+            if len(dst) < n:
+                raise ValueError("output buffer is too small: %d < %d" % (len(dst), n))
+            unpack = _BLOCK.unpack_from
+            pack = _BLOCK.pack_into
+            for offset in range(0, n, 16):
+                pack(dst, offset, *function(*unpack(src, offset), rk, nbrRounds))
+    return result
+
+def encryptBlockRuns(buf, runs, out=None):
+    """Encrypts the blocks of buf with different keys.
+
+    runs is a list of (aesKey, nbrBlocks): the first nbrBlocks blocks of buf are encrypted
+    with the first aesKey, the next blocks with the second aesKey, and so on.
+    With the numpy engine, the blocks of all runs are encrypted together (with the round keys
+    gathered per block), so many short runs cost about the same as one long run.
+    Returns the output buffer, as encrypt_blocks.
+    """
+    total = sum(nbrBlocks for aesKey, nbrBlocks in runs)
+    if 16 * total != len(buf):
+        raise ValueError("the runs don't cover the buffer: %d blocks, %d bytes" % (total, len(buf)))
+    result = bytearray(len(buf)) if out is None else out
+    with memoryview(buf) as view, view.cast('B') as src, \
+         memoryview(result) as resultView, resultView.cast('B') as dst:
+        if dst.readonly or len(dst) < len(src):
+            raise ValueError("output buffer is read-only or too small")
+        if blockEngine == "numpy" and total >= NUMPY_MIN_BLOCKS:
+            _numpyEncryptRuns(src, dst, runs)
+        else:
+            offset = 0
+            for aesKey, nbrBlocks in runs:
+                end = offset + 16 * nbrBlocks
+                aesKey.encrypt_blocks(src[offset:end], out=dst[offset:end])
+                offset = end
+    return result
+
+def _numpyEncryptRuns(src, dst, runs):
+    blocks = numpy.frombuffer(src, dtype=numpy.uint8).reshape(-1, 16)
+    target = numpy.frombuffer(dst, dtype=numpy.uint8)[:len(src)].reshape(-1, 16)
+    # the number of rounds depends on the key size, so the blocks are grouped by key size:
+    # for every group the block numbers, the key number of every block and the keys
+    groups = collections.defaultdict(lambda: ([], [], []))
+    first = 0
+    for aesKey, nbrBlocks in runs:
+        blockIndex, keyIndex, keys = groups[aesKey.nbrRounds]
+        if not keys or keys[-1] is not aesKey:
+            keys.append(aesKey)
+        blockIndex.append(numpy.arange(first, first + nbrBlocks))
+        keyIndex.append(numpy.full(nbrBlocks, len(keys) - 1))
+        first += nbrBlocks
+    for blockIndex, keyIndex, keys in groups.values():
+        blockIndex = numpy.concatenate(blockIndex)
+        keyIndex = numpy.concatenate(keyIndex)
+        # (Nr+1, number of keys, 16): the round keys of all keys
+        allRoundKeys = numpy.stack([aesKey.numpyRoundKeys() for aesKey in keys], axis=1)
+        for i in range(0, len(blockIndex), NUMPY_CHUNK_BLOCKS):
+            index = blockIndex[i:i+NUMPY_CHUNK_BLOCKS]
+            # (Nr+1, blocks, 16): the round keys of every block
+            roundKeys = allRoundKeys[:, keyIndex[i:i+NUMPY_CHUNK_BLOCKS]]
+            target[index] = _numpyEncrypt(blocks[index], roundKeys)
+    del blocks, target
+
+#
+# AES-CMAC (RFC 4493): a message authentication code based on AES in CBC mode.
+#
+# The message is CBC encrypted with a zero IV and only the last ciphertext block is kept,
+# so there is no need to store the ciphertext. Before the last block is encrypted, it is
+# XORed with subkey K1 (complete block) or K2 (padded block). The subkeys are derived from
+# the encryption of the zero block once per key and stored with the (cached) AESKey.
+#
+def _cmacDouble(x):
+    """Multiplication by x in GF(2^128), as in RFC 4493"""
+    return ((x << 1) & 0xffffffffffffffffffffffffffffffff) ^ (0x87 if x >> 127 else 0)
+
+def cmacSubkeys(aesKey):
+    """Returns the CMAC subkeys K1 and K2 (as 4 words each) of an AESKey"""
+    if aesKey.cmacSubkeys is None:
+        L = int.from_bytes(aesKey.encrypt(bytes(16)), 'big')
+        K1 = _cmacDouble(L)
+        K2 = _cmacDouble(K1)
+        aesKey.cmacSubkeys = (_BLOCK.unpack(K1.to_bytes(16, 'big')), _BLOCK.unpack(K2.to_bytes(16, 'big')))
+    return aesKey.cmacSubkeys
+
+class CMAC(object):
+    """AES-CMAC, with the same interface as the hmac and hashlib objects: update/digest/hexdigest/copy"""
+
+    digest_size = 16
+    block_size = 16
+
+    def __init__(self, key, msg=None, size=None):
+        self._aesKey = getAESKey(key, size)
+        self._K1, self._K2 = cmacSubkeys(self._aesKey)
+        # the CBC state, and the data that is not encrypted yet (at most one block)
+        self._state = (0, 0, 0, 0)
+        self._buffer = b''
+        if msg is not None:
+            self.update(msg)
+
+    def update(self, msg):
+        data = self._buffer + bytes(msg)
+        # the last block (even if it is complete) is kept for digest
+        n = (len(data) - 1) // 16 * 16 if data else 0
+        s0, s1, s2, s3 = self._state
+        encryptWords = self._aesKey.encryptWords
+        unpack = _BLOCK.unpack_from
+        for offset in range(0, n, 16):
+            m0, m1, m2, m3 = unpack(data, offset)
+            s0, s1, s2, s3 = encryptWords(s0 ^ m0, s1 ^ m1, s2 ^ m2, s3 ^ m3)
+        self._state = (s0, s1, s2, s3)
+        self._buffer = data[n:]
+
+    def digest(self):
+        if len(self._buffer) == 16:
+            last, K = self._buffer, self._K1
+        else:
+            last, K = self._buffer + b'\x80' + bytes(15 - len(self._buffer)), self._K2
+        words = [s ^ m ^ k for s, m, k in zip(self._state, _BLOCK.unpack(last), K)]
+        return _BLOCK.pack(*self._aesKey.encryptWords(*words))
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+    def copy(self):
+        other = CMAC.__new__(CMAC)
+        other._aesKey, other._K1, other._K2 = self._aesKey, self._K1, self._K2
+        other._state, other._buffer = self._state, self._buffer
+        return other
+
+    def verify(self, tag, minTagLength=16):
+        """Returns True if tag is the MAC of the message, in constant time.
+
+        The tag can be truncated to minTagLength bytes (16 by default, at least 8):
+        shorter tags are rejected, because they are too easy to guess.
+        """
+        if not 8 <= minTagLength <= 16:
+            raise ValueError("the minimum tag length should be between 8 and 16 bytes")
+        if not minTagLength <= len(tag) <= 16:
+            return False
+        return hmac.compare_digest(self.digest()[:len(tag)], bytes(tag))
+
+def verify_many(jobs, minTagLength=16):
+    """Verifies many (key, msg, tag) triples, returns a list of True/False in the same order.
+
+    The messages are grouped by key, so the key schedule and the subkeys are set up
+    only once for every key. A job with an invalid key is not verified (False).
+    minTagLength is as for CMAC.verify.
+    """
+    if not 8 <= minTagLength <= 16:
+        raise ValueError("the minimum tag length should be between 8 and 16 bytes")
+    results = [False] * len(jobs)
+    groups = collections.defaultdict(list)
+    for i, (key, msg, tag) in enumerate(jobs):
+        groups[bytes(key)].append(i)
+    for key, indices in groups.items():
+        try:
+            start = CMAC(key)
+        except ValueError:
+            continue
+        for i in indices:
+            mac = start.copy()
+            mac.update(jobs[i][1])
+            results[i] = mac.verify(jobs[i][2], minTagLength)
+    return results
+
+class KeyScheduleCache(object):
+    """A bounded LRU cache of expanded keys (AESKey objects).
+
+    The cache is indexed by the key bytes and the key size. When the cache is full,
+    the least recently used key is evicted.
+    hits, misses and evictions count what happened since the creation of the cache
+    (or the last call to resetStats).
+    """
+
+    def __init__(self, maxsize=1024):
+        if maxsize < 0:
+            raise ValueError("maxsize can't be negative")
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.resetStats()
+
+    def get(self, key, size=None):
+        """Returns the AESKey for key, expanding the key only if it is not in the cache"""
+        if size is None:
+            size = len(key)
+        index = (bytes(key[:size]), size)
+        with self._lock:
+            aesKey = self._keys.get(index)
+            if aesKey is not None:
+                self._keys.move_to_end(index)
+                self.hits += 1
+                return aesKey
+            self.misses += 1
+        aesKey = AESKey(key, size)
+        with self._lock:
+            if self.maxsize > 0:
+                self._keys[index] = aesKey
+                self._keys.move_to_end(index)
+                self._evict()
+        return aesKey
+
+    def discard(self, key, size=None):
+        """Removes one key from the cache, e.g. when that key is rotated"""
+        if size is None:
+            size = len(key)
+        with self._lock:
+            self._keys.pop((bytes(key[:size]), size), None)
+
+    def clear(self):
+        """Removes all keys from the cache.
+
+        After this call the cache holds no references to key material anymore.
+        """
+        with self._lock:
+            self._keys.clear()
+
+    def resize(self, maxsize):
+        """Changes the maximum number of keys in the cache, evicting keys if needed"""
+        if maxsize < 0:
+            raise ValueError("maxsize can't be negative")
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Returns the cache counters as a dict"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    size=len(self._keys), maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _evict(self):
+        # the lock should be held by the caller
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+            self.evictions += 1
+
+# process wide cache of expanded keys, used by AES.encrypt/decrypt and the modes of operation
+keyCache = KeyScheduleCache()
+
+def getAESKey(key, size=None):
+    """Returns the (cached) AESKey for key"""
+    return keyCache.get(key, size)
 
 if __name__ == "__main__":
     import secrets
+    # PKCS7 padding: all the padding bytes are checked
+    assert strip_PKCS7_padding(b'A'*13 + b'\x03\x03\x03') == b'A'*13
+    try:
+        strip_PKCS7_padding(b'A'*13 + b'\x01\x02\x03')
+        assert False
+    except ValueError:
+        pass
+
     cleartext = [100,101,102,103,104,105,106,107,108,109,110,111,112,113,114,115]
     key = [143,194,34,208,145,203,230,143,177,246,97,206,145,92,255,84]
     aes = AES()
@@ -476,3 +1132,64 @@ if __name__ == "__main__":
     except:
         raise ValueError("***ERROR***")
 
+    # the T-table implementation should give exactly the same results as the reference implementation
+    for size in (16, 24, 32):
+        cleartext = secrets.token_bytes(16)
+        key = secrets.token_bytes(size)
+        cipher = AES().encrypt(cleartext, key, size)
+        assert TableAES().encrypt(cleartext, key, size) == cipher
+        assert TableAES().decrypt(cipher, key, size) == cleartext
+
+    # an AESKey expands the key once and can then be used for many blocks
+    key = secrets.token_bytes(32)
+    aesKey = AESKey(key)
+    for i in range(4):
+        cleartext = secrets.token_bytes(16)
+        cipher = AES().encrypt(cleartext, key, 32)
+        assert aesKey.encrypt(cleartext) == cipher
+        assert aesKey.decrypt(cipher) == cleartext
+        assert AES().encryptBlock(cleartext, aesKey) == cipher
+        assert AES().decryptBlock(cipher, aesKey) == cleartext
+
+    # the key cache evicts the least recently used key when it is full
+    cache = KeyScheduleCache(2)
+    keys = [secrets.token_bytes(16) for i in range(3)]
+    assert cache.get(keys[0]) is cache.get(keys[0])
+    cache.get(keys[1])
+    cache.get(keys[2])
+    assert cache.stats() == dict(hits=1, misses=3, evictions=1, size=2, maxsize=2)
+    cache.clear()
+    assert len(cache) == 0
+
+    # encrypt_blocks/decrypt_blocks process many blocks at once
+    key = secrets.token_bytes(16)
+    cleartext = secrets.token_bytes(16*5)
+    cipher = AES().encrypt_blocks(cleartext, key, 16)
+    for i in range(5):
+        assert cipher[16*i:16*i+16] == AES().encrypt(cleartext[16*i:16*i+16], key, 16)
+    buf = bytearray(cipher)
+    AES().decrypt_blocks(buf, key, 16, out=buf)
+    assert buf == cleartext
+
+    # the numpy engine (if numpy is installed) gives the same results as the T-table implementation
+    if numpy is not None:
+        key = secrets.token_bytes(24)
+        cleartext = secrets.token_bytes(16*NUMPY_MIN_BLOCKS)
+        cipher = AES().encrypt_blocks(cleartext, key, 24)
+        setBlockEngine("table")
+        assert cipher == AES().encrypt_blocks(cleartext, key, 24)
+        setBlockEngine("numpy")
+        assert AES().decrypt_blocks(cipher, key, 24) == cleartext
+
+    # AES-CMAC (the examples of RFC 4493)
+    key = bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c')
+    assert CMAC(key).hexdigest() == 'bb1d6929e95937287fa37d129b756746'
+    mac = CMAC(key, bytes.fromhex('6bc1bee22e409f96e93d7e117393172a'))
+    assert mac.hexdigest() == '070a16b46b4d4144f79bdd9dd04a287c'
+    assert verify_many([(key, b'', bytes.fromhex('bb1d6929e95937287fa37d129b756746')),
+                        (key, b'', bytes(16))]) == [True, False]
+    # truncated tags only down to minTagLength, and a bad key only fails its own job
+    assert not CMAC(key).verify(bytes.fromhex('bb'))
+    assert CMAC(key).verify(bytes.fromhex('bb1d6929e9593728'), minTagLength=8)
+    assert verify_many([(bytes(5), b'', bytes(16)),
+                        (key, b'', bytes.fromhex('bb1d6929e95937287fa37d129b756746'))]) == [False, True]
@@ -20,7 +20,9 @@
 #
 # This module uses the aes encryption algorithm and adds modes of operation.
 # The modes of operation OFB, CFB, CBC and CTR are supported.
-# No authenticated modes of encryption are supported.
+# ECB is supported as well, but only to show why it should not be used: equal blocks give equal ciphertext.
+# The authenticated mode GCM is supported by GCMEncryptor/GCMDecryptor (or encryptGCM/decryptGCM).
+# The XTS mode for encrypted storage is supported by the XTS class.
 # A pure block cipher suc as AES can only encrypt/decrypt the exact block size input, i.e. 128 bits.
 # Modes of operation extend this encrypt/decrypt capability to arbitrary lengths.
 # This means we can encrypt/decrypt inputs of less than and more than 128 bits.
@@ -30,7 +32,14 @@
 #
 
 from cryptocourse import aes
-import math
+from cryptocourse.aes import _BLOCK
+import os
+import hmac
+import mmap
+import struct
+import shutil
+import secrets
+import concurrent.futures
 
 class AESModeOfOperation(object):
 
@@ -38,7 +47,11 @@ class AESModeOfOperation(object):
     bytes_string = False
 
     # structure of supported modes of operation
-    modeOfOperation = dict(OFB=0, CFB=1, CBC=2, CTR=3)
+    modeOfOperation = dict(OFB=0, CFB=1, CBC=2, CTR=3, ECB=4)
+
+    # CTR: the number of bits of the counter in the counter block,
+    # 32 (96-bit nonce, the default) or 64 (64-bit nonce)
+    counterBits = 32
 
     # converts a 16 character string into a number array
     def convertString(self, string, start, end, mode):
@@ -59,14 +72,35 @@ class AESModeOfOperation(object):
             i += 1
         return ar
 
-    def convertToList(self, ctr):
+    def ctrKeystream(self, aesKey, IV, nbrBlocks, firstBlock=0):
+        """
+        Returns the CTR keystream for nbrBlocks blocks, starting at block number firstBlock.
+        All counter blocks are encrypted at once by the block engine (see aes.AESKey.encrypt_blocks).
         """
-        The ctr value is a (large) number; the return value should be a list of ints (bytes)
+        counters = self.ctrCounterBlocks(IV, nbrBlocks, firstBlock)
+        return aesKey.encrypt_blocks(counters, out=counters)
+
+    def ctrCounterBlocks(self, IV, nbrBlocks, firstBlock=0):
         """
-        hexstr = hex(ctr)[2:]
-        if len(hexstr) % 2 == 1:
-            hexstr = '0' + hexstr
-        return list(bytes.fromhex(hexstr))
+        Returns the counter blocks for nbrBlocks blocks, starting at block number firstBlock.
+        The counter block of block 0 is the nonce (the first 16 - counterBits/8 bytes of the IV)
+        followed by a counter of counterBits zero bits. See CounterBlock.
+        """
+        return CounterBlock(IV, self.counterBits, firstBlock).fill(nbrBlocks)
+
+    # ECB encrypts all blocks independently, so all blocks are encrypted at once by the block engine.
+    # Like CBC, the last block is padded with zeros; the original size is needed to decrypt.
+    def encryptECB(self, data, aesKey):
+        buf = bytearray(data)
+        buf += bytes(-len(buf) % 16)
+        return bytes(aesKey.encrypt_blocks(buf, out=buf))
+
+    def decryptECB(self, data, originalsize, aesKey):
+        buf = bytearray(data)
+        aesKey.decrypt_blocks(buf, out=buf)
+        if originalsize is not None:
+            del buf[originalsize:]
+        return bytes(buf)
 
     # Mode of Operation Encryption
     # stringIn - Input String
@@ -75,116 +109,14 @@ class AESModeOfOperation(object):
     # size - the bit length of the key
     # hexIV - the 128 bit hex Initilization Vector
     def encrypt(self, stringIn, mode, key, size, IV):
-        if isinstance(stringIn, bytes):
-            bytes_string = True
-        else:
-            bytes_string = False
-        if isinstance(key,bytes):
-            key = list(key)
-        if isinstance(IV, bytes):
-            IV = list(IV)
         if len(key) % size:
             return None
         if len(IV) % 16:
             return None
-        # the AES input/output
-        plaintext = []
-        iput = [0] * 16
-        output = []
-        ciphertext = [0] * 16
-        # the output cipher string
-        if bytes_string:
-            cipherOut = b''
-        else:
-            cipherOut = []
-        # char firstRound
-        firstRound = True
-        if stringIn != None:
-            for j in range(int(math.ceil(float(len(stringIn))/16))):
-                start = j*16
-                end = j*16+16
-                if  end > len(stringIn):
-                    end = len(stringIn)
-                plaintext = self.convertString(stringIn, start, end, mode)
-                # print 'PT@%s:%s' % (j, plaintext)
-                if mode == self.modeOfOperation["CFB"]:
-                    if firstRound:
-                        output = self.aes.encrypt(IV, key, size)
-                        firstRound = False
-                    else:
-                        output = self.aes.encrypt(iput, key, size)
-                    for i in range(16):
-                        if len(plaintext)-1 < i:
-                            ciphertext[i] = 0 ^ output[i]
-                        elif len(output)-1 < i:
-                            ciphertext[i] = plaintext[i] ^ 0
-                        elif len(plaintext)-1 < i and len(output) < i:
-                            ciphertext[i] = 0 ^ 0
-                        else:
-                            ciphertext[i] = plaintext[i] ^ output[i]
-                    if bytes_string:
-                        cipherOut += bytes(ciphertext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            cipherOut.append(ciphertext[k])
-                    iput = ciphertext
-                elif mode == self.modeOfOperation["OFB"]:
-                    if firstRound:
-                        output = self.aes.encrypt(IV, key, size)
-                        firstRound = False
-                    else:
-                        output = self.aes.encrypt(iput, key, size)
-                    for i in range(16):
-                        if len(plaintext)-1 < i:
-                            ciphertext[i] = 0 ^ output[i]
-                        elif len(output)-1 < i:
-                            ciphertext[i] = plaintext[i] ^ 0
-                        elif len(plaintext)-1 < i and len(output) < i:
-                            ciphertext[i] = 0 ^ 0
-                        else:
-                            ciphertext[i] = plaintext[i] ^ output[i]
-                    if bytes_string:
-                        cipherOut += bytes(ciphertext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            cipherOut.append(ciphertext[k])
-                    iput = output
-                elif mode == self.modeOfOperation["CBC"]:
-                    for i in range(16):
-                        if firstRound:
-                            iput[i] =  plaintext[i] ^ IV[i]
-                        else:
-                            iput[i] =  plaintext[i] ^ ciphertext[i]
-                    # print 'IP@%s:%s' % (j, iput)
-                    firstRound = False
-                    ciphertext = self.aes.encrypt(iput, key, size)
-                    # always 16 bytes because of the padding for CBC
-                    if bytes_string:
-                        cipherOut += ciphertext
-                    else:
-                        for k in range(16):
-                            cipherOut.append(ciphertext[k])
-                elif mode == self.modeOfOperation["CTR"]:
-                    if firstRound:
-                        counter = int.from_bytes(bytes(IV[0:12] + [0,0,0,0]))
-                        counterlist = self.convertToList(counter)
-                        output = self.aes.encrypt(counterlist, key, size)
-                        firstRound = False
-                    else:
-                        counter = counter + 1
-                        counterlist = self.convertToList(counter)
-                        output = self.aes.encrypt(counterlist, key, size)
-                    for i in range(16):
-                        if len(plaintext)-1 < i:
-                            ciphertext[i] = 0 ^ output[i]
-                        else:
-                            ciphertext[i] = plaintext[i] ^ output[i]
-                    if bytes_string:
-                        cipherOut += bytes(ciphertext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            cipherOut.append(ciphertext[k])
-        return mode, len(stringIn), cipherOut
+        if isinstance(stringIn, str):
+            cipherOut = self.encryptBytes(bytes(map(ord, stringIn)), mode, key, size, IV)
+            return mode, len(stringIn), list(cipherOut)
+        return mode, len(stringIn), self.encryptBytes(stringIn, mode, key, size, IV)
 
     # Mode of Operation Decryption
     # cipherIn - Encrypted String
@@ -194,169 +126,1003 @@ class AESModeOfOperation(object):
     # size - the bit length of the key
     # IV - the 128 bit number array Initilization Vector
     def decrypt(self, cipherIn, originalsize, mode, key, size, IV):
-        # cipherIn = unescCtrlChars(cipherIn)
-        if isinstance(cipherIn, bytes):
-            bytes_string = True
-        else:
-            bytes_string = False
         if len(key) % size:
             return None
-        if isinstance(key,bytes):
-            key = list(key)
-        if isinstance(IV, bytes):
-            IV = list(IV)
         if len(IV) % 16:
             return None
-        # the AES input/output
-        ciphertext = []
-        iput = []
-        output = []
-        plaintext = [0] * 16
-        # the output plain text string
-        if bytes_string:
-            stringOut = b''
-        else:
-            stringOut = ''
-        # char firstRound
-        firstRound = True
-        if cipherIn != None:
-            for j in range(int(math.ceil(float(len(cipherIn))/16))):
-                start = j*16
-                end = j*16+16
-                if j*16+16 > len(cipherIn):
-                    end = len(cipherIn)
-                ciphertext = cipherIn[start:end]
-                if mode == self.modeOfOperation["CFB"]:
-                    if firstRound:
-                        output = self.aes.encrypt(IV, key, size)
-                        firstRound = False
-                    else:
-                        output = self.aes.encrypt(iput, key, size)
-                    for i in range(16):
-                        if len(output)-1 < i:
-                            plaintext[i] = 0 ^ ciphertext[i]
-                        elif len(ciphertext)-1 < i:
-                            plaintext[i] = output[i] ^ 0
-                        elif len(output)-1 < i and len(ciphertext) < i:
-                            plaintext[i] = 0 ^ 0
-                        else:
-                            plaintext[i] = output[i] ^ ciphertext[i]
-                    if bytes_string:
-                        stringOut += bytes(plaintext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            stringOut += chr(plaintext[k])
-                    iput = ciphertext
-                elif mode == self.modeOfOperation["OFB"]:
-                    if firstRound:
-                        output = self.aes.encrypt(IV, key, size)
-                        firstRound = False
-                    else:
-                        output = self.aes.encrypt(iput, key, size)
-                    for i in range(16):
-                        if len(output)-1 < i:
-                            plaintext[i] = 0 ^ ciphertext[i]
-                        elif len(ciphertext)-1 < i:
-                            plaintext[i] = output[i] ^ 0
-                        elif len(output)-1 < i and len(ciphertext) < i:
-                            plaintext[i] = 0 ^ 0
-                        else:
-                            plaintext[i] = output[i] ^ ciphertext[i]
-                    if bytes_string:
-                        stringOut += bytes(plaintext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            stringOut += chr(plaintext[k])
-                    iput = output
-                elif mode == self.modeOfOperation["CBC"]:
-                    output = self.aes.decrypt(ciphertext, key, size)
-                    for i in range(16):
-                        if firstRound:
-                            plaintext[i] = IV[i] ^ output[i]
-                        else:
-                            plaintext[i] = iput[i] ^ output[i]
-                    firstRound = False
-                    if originalsize is not None and originalsize < end:
-                        if bytes_string:
-                            stringOut += bytes(plaintext)[:originalsize-start]
-                        else:
-                            for k in range(originalsize-start):
-                                stringOut += chr(plaintext[k])
-                    else:
-                        if bytes_string:
-                            stringOut += bytes(plaintext)
-                        else:
-                            for k in range(end-start):
-                                stringOut += chr(plaintext[k])
-                    iput = ciphertext
-                elif mode == self.modeOfOperation["CTR"]:
-                    if firstRound:
-                        counter = int.from_bytes(bytes(IV[0:12] + [0,0,0,0]))
-                        counterlist = self.convertToList(counter)
-                        output = self.aes.encrypt(counterlist, key, size)
-                        firstRound = False
-                    else:
-                        counter = counter + 1
-                        counterlist = self.convertToList(counter)
-                        output = self.aes.encrypt(counterlist, key, size)
-                    for i in range(16):
-                        if len(ciphertext)-1 < i:
-                            plaintext[i] = output[i] ^ 0
-                        else:
-                            plaintext[i] = output[i] ^ ciphertext[i]
-                    if bytes_string:
-                        stringOut += bytes(plaintext)[:end-start]
-                    else:
-                        for k in range(end-start):
-                            stringOut += chr(plaintext[k])
-                    iput = ciphertext
+        if isinstance(cipherIn, list):
+            # a list of ints is the result of encrypting a standard string
+            stringOut = self.decryptBytes(bytes(cipherIn), originalsize, mode, key, size, IV)
+            return stringOut.decode('latin-1')
+        return self.decryptBytes(cipherIn, originalsize, mode, key, size, IV)
+
+    # The bytes engine of the modes of operation.
+    # The input can be any bytes-like object. The output is written into one preallocated buffer,
+    # and the XOR with the keystream is done on whole blocks (or on the whole message at once)
+    # instead of byte by byte.
+    def encryptBytes(self, data, mode, key, size, IV):
+        """Encrypts the bytes-like data, returns bytes (CBC and ECB: padded with zeros)"""
+        aesKey = aes.getAESKey(key, size)
+        IV = bytes(IV[0:16])
+        n = len(data)
+        nbrBlocks = (n + 15) // 16
+        if mode == self.modeOfOperation["CTR"]:
+            return _xorBytes(data, self.ctrKeystream(aesKey, IV, nbrBlocks), n)
+        if mode == self.modeOfOperation["OFB"]:
+            return _xorBytes(data, self.ofbKeystream(aesKey, IV, nbrBlocks), n)
+        if mode == self.modeOfOperation["ECB"]:
+            return self.encryptECB(data, aesKey)
+        if mode not in (self.modeOfOperation["CBC"], self.modeOfOperation["CFB"]):
+            raise ValueError("unknown mode of operation: %s" % mode)
+        # CBC and CFB: every block depends on the previous ciphertext block.
+        # The output buffer is the (zero padded) input, which is encrypted in place.
+        buf = bytearray(16 * nbrBlocks)
+        buf[:n] = data
+        if mode == self.modeOfOperation["CBC"]:
+            _cbcEncrypt(aesKey, buf, IV)
+            return bytes(buf)
+        _cfbEncrypt(aesKey, buf, IV)
+        return bytes(buf[:n])
+
+    def decryptBytes(self, data, originalsize, mode, key, size, IV):
+        """Decrypts the bytes-like data, returns bytes (CBC and ECB: truncated to originalsize)"""
+        aesKey = aes.getAESKey(key, size)
+        IV = bytes(IV[0:16])
+        n = len(data)
+        nbrBlocks = (n + 15) // 16
+        if mode == self.modeOfOperation["CTR"]:
+            return _xorBytes(data, self.ctrKeystream(aesKey, IV, nbrBlocks), n)
+        if mode == self.modeOfOperation["OFB"]:
+            return _xorBytes(data, self.ofbKeystream(aesKey, IV, nbrBlocks), n)
+        if mode == self.modeOfOperation["ECB"]:
+            return self.decryptECB(data, originalsize, aesKey)
+        if mode == self.modeOfOperation["CBC"]:
+            stringOut = _cbcDecrypt(aesKey, data, IV)
+            if originalsize is not None:
+                stringOut = stringOut[:originalsize]
+            return stringOut
+        if mode == self.modeOfOperation["CFB"]:
+            return _cfbDecrypt(aesKey, data, IV)
+        raise ValueError("unknown mode of operation: %s" % mode)
+
+    # CTR mode: every keystream block only depends on its counter block.
+    # So the keystream at any position can be computed directly (random access),
+    # and different parts of a message can be encrypted by different processes.
+    def ctrCrypt(self, data, key, size, IV, offset=0):
+        """
+        Encrypts (or decrypts, which is the same) data that starts at byte offset in the CTR stream.
+        Only the keystream blocks that overlap with data are computed.
+        """
+        aesKey = aes.getAESKey(key, size)
+        n = len(data)
+        skip = offset % 16
+        nbrBlocks = (skip + n + 15) // 16
+        keystream = self.ctrKeystream(aesKey, IV, nbrBlocks, offset // 16)
+        with memoryview(keystream) as view:
+            return _xorBytes(data, view[skip:], n)
+
+    def ctrCryptParallel(self, data, key, size, IV, offset=0, workers=None, executor=None):
+        """
+        Same as ctrCrypt, but the data is split into one chunk per worker, and
+        every chunk is processed by a separate process.
+        An existing concurrent.futures executor can be given, otherwise a process pool
+        with workers processes (default: the number of CPUs) is created for this call.
+        """
+        # the chunks start at a block boundary of the CTR stream
+        chunks = _splitChunks(len(data), workers, offset % 16)
+        if len(chunks) == 1:
+            return self.ctrCrypt(data, key, size, IV, offset)
+        key, IV = bytes(key), bytes(IV[0:16])
+        with memoryview(data) as view:
+            jobs = [(bytes(view[start:end]), key, size, IV, offset + start, self.counterBits)
+                    for start, end in chunks]
+        return b''.join(_runParallel(_ctrWorker, jobs, workers, executor))
+
+    # CBC and CFB decryption: every plaintext block only depends on its own ciphertext block
+    # and the previous one. So the ciphertext can be split into chunks that are decrypted by
+    # different processes; every chunk also gets the last ciphertext block before it.
+    def decryptParallel(self, cipherIn, originalsize, mode, key, size, IV, workers=None, executor=None):
+        """
+        Same as decrypt for bytes-like input in the CBC or CFB mode, but the chunks of the
+        ciphertext are decrypted in parallel. See ctrCryptParallel for workers and executor.
+        """
+        if mode not in (self.modeOfOperation["CBC"], self.modeOfOperation["CFB"]):
+            raise ValueError("parallel decryption is only possible for CBC and CFB")
+        if len(key) % size:
+            return None
+        if len(IV) % 16:
+            return None
+        chunks = _splitChunks(len(cipherIn), workers)
+        if len(chunks) == 1:
+            return self.decryptBytes(cipherIn, originalsize, mode, key, size, IV)
+        key, IV = bytes(key), bytes(IV[0:16])
+        with memoryview(cipherIn) as view:
+            jobs = [(bytes(view[start:end]), bytes(view[start-16:start]) if start else IV, mode, key, size)
+                    for start, end in chunks]
+        stringOut = b''.join(_runParallel(_decryptWorker, jobs, workers, executor))
+        if mode == self.modeOfOperation["CBC"] and originalsize is not None:
+            stringOut = stringOut[:originalsize]
         return stringOut
 
+    # Many small messages: the per-call overhead of encrypt is larger than the encryption itself.
+    def encryptMany(self, jobs):
+        """
+        Encrypts many messages at once. jobs is a list of (key, IV, mode, plaintext),
+        the key size is the length of the key. Returns the ciphertexts (as encryptBytes)
+        in the same order as the jobs.
+        Every key is expanded once, and the blocks of all CTR and ECB jobs (the counter blocks
+        and the plaintext blocks) are encrypted together by the block engine.
+        """
+        results = [None] * len(jobs)
+        aesKeys = {}
+        runs = []
+        batched = []
+        batch = bytearray()
+        for i, (key, IV, mode, plaintext) in enumerate(jobs):
+            index = bytes(key)
+            if index not in aesKeys:
+                aesKeys[index] = aes.getAESKey(key, len(key))
+            aesKey = aesKeys[index]
+            if mode == self.modeOfOperation["CTR"]:
+                blocks = self.ctrCounterBlocks(IV, (len(plaintext) + 15) // 16)
+            elif mode == self.modeOfOperation["ECB"]:
+                blocks = bytes(plaintext) + bytes(-len(plaintext) % 16)
+            else:
+                results[i] = self.encryptBytes(plaintext, mode, key, len(key), IV)
+                continue
+            batched.append((i, len(batch)))
+            runs.append((aesKey, len(blocks) // 16))
+            batch += blocks
+        aes.encryptBlockRuns(batch, runs, out=batch)
+        with memoryview(batch) as view:
+            for i, offset in batched:
+                key, IV, mode, plaintext = jobs[i]
+                if mode == self.modeOfOperation["CTR"]:
+                    results[i] = _xorBytes(plaintext, view[offset:], len(plaintext))
+                else:
+                    results[i] = bytes(view[offset:offset + len(plaintext) + (-len(plaintext) % 16)])
+        return results
 
-def encryptData(key, data, mode=AESModeOfOperation.modeOfOperation["CBC"]):
-    """encrypt `data` using `key`
+    def encryptor(self, mode, key, size, IV, padding=None):
+        """Returns an Encryptor, to encrypt a message chunk by chunk"""
+        return Encryptor(mode, key, size, IV, padding, self.counterBits)
+
+    def decryptor(self, mode, key, size, IV, padding=None):
+        """Returns a Decryptor, to decrypt a message chunk by chunk"""
+        return Decryptor(mode, key, size, IV, padding, self.counterBits)
+
+    def ofbKeystream(self, aesKey, IV, nbrBlocks):
+        """Returns the OFB keystream for nbrBlocks blocks: the IV encrypted again and again"""
+        keystream = bytearray(16 * nbrBlocks)
+        encryptWords = aesKey.encryptWords
+        pack = _BLOCK.pack_into
+        words = _BLOCK.unpack_from(bytes(IV), 0)
+        for offset in range(0, 16 * nbrBlocks, 16):
+            words = encryptWords(*words)
+            pack(keystream, offset, *words)
+        return keystream
+
+def _xorBytes(a, b, n):
+    """XORs the first n bytes of the bytes-like objects a and b, as one big number"""
+    with memoryview(a) as va, memoryview(b) as vb:
+        return (int.from_bytes(va[:n], 'little') ^
+                int.from_bytes(vb[:n], 'little')).to_bytes(n, 'little')
+
+def _xorInto(out, a, b, n):
+    """Writes the XOR of the first n bytes of a and b into the writable buffer out.
+    out may be a or b itself."""
+    if n == 0:
+        return
+    if aes.blockEngine == "numpy":
+        numpy = aes.numpy
+        target = numpy.frombuffer(out, dtype=numpy.uint8, count=n)
+        numpy.bitwise_xor(numpy.frombuffer(a, dtype=numpy.uint8, count=n),
+                          numpy.frombuffer(b, dtype=numpy.uint8, count=n), out=target)
+    else:
+        with memoryview(out) as view:
+            view[:n] = _xorBytes(a, b, n)
+
+#
+# The CTR counter block: a nonce followed by a big endian counter, 16 bytes in total.
+# The split between nonce and counter is configurable: a 96-bit nonce with a 32-bit counter
+# (the default, as in GCM) or a 64-bit nonce with a 64-bit counter.
+# Only the counter part is incremented, the nonce never changes. When the counter is exhausted,
+# the next block raises OverflowError, because a repeated counter block repeats the keystream.
+# increment() and fill() can both use the last counter value; after that, the counter is mask + 1
+# and the block itself raises OverflowError, so it can't be mistaken for the first one.
+# With wrap=True, the counter wraps around to 0 instead (this is inc32 of GCM).
+#
+# one counter block as 2 big endian 64-bit words
+_COUNTER = struct.Struct('>QQ')
+
+class CounterBlock(object):
+    """A 16-byte CTR counter block, incremented in place"""
+
+    def __init__(self, nonce, counterBits=32, counter=0, wrap=False):
+        if counterBits % 8 or not 8 <= counterBits <= 128:
+            raise ValueError("the counter should be a whole number of bytes, at most 16")
+        nonceLength = 16 - counterBits // 8
+        if len(nonce) < nonceLength:
+            raise ValueError("the nonce should be %d bytes" % nonceLength)
+        self.counterBits = counterBits
+        self.wrap = wrap
+        self._block = bytearray(16)
+        self._block[:nonceLength] = bytes(nonce[:nonceLength])
+        self._nonceLength = nonceLength
+        self._prefix = int.from_bytes(self._block, 'big')
+        self._mask = (1 << counterBits) - 1
+        self.counter = counter
+
+    @property
+    def counter(self):
+        """The value of the counter in the next block"""
+        return self._counter
+
+    @counter.setter
+    def counter(self, value):
+        if self.wrap:
+            value &= self._mask
+        elif not 0 <= value <= self._mask + 1:
+            # mask + 1: all counter blocks have been used
+            raise OverflowError("the CTR counter is out of range")
+        self._counter = value
+        self._block[self._nonceLength:] = (value & self._mask).to_bytes(16 - self._nonceLength, 'big')
+
+    @property
+    def block(self):
+        """The next counter block (a bytearray, changed in place)"""
+        if self._counter > self._mask:
+            raise OverflowError("the CTR counter is exhausted")
+        return self._block
+
+    def __bytes__(self):
+        return bytes(self.block)
+
+    def increment(self):
+        """Adds 1 to the counter, in place in the last bytes of the block"""
+        if self._counter > self._mask:
+            raise OverflowError("the CTR counter is exhausted")
+        self._counter += 1
+        if self.wrap:
+            self._counter &= self._mask
+        block = self._block
+        i = 15
+        while i >= self._nonceLength:
+            block[i] = (block[i] + 1) & 0xff
+            if block[i]:
+                break
+            i -= 1
+
+    def fill(self, nbrBlocks, out=None):
+        """
+        Writes the next nbrBlocks counter blocks into out (default: a new bytearray)
+        and advances the counter by nbrBlocks. Returns out.
+        """
+        if out is None:
+            out = bytearray(16 * nbrBlocks)
+        if not self.wrap and self._counter + nbrBlocks > self._mask + 1:
+            raise OverflowError("the CTR counter is exhausted")
+        pack = _COUNTER.pack_into
+        prefix, counter, mask = self._prefix, self._counter, self._mask
+        offset = 0
+        while nbrBlocks:
+            # the blocks until the counter wraps
+            count = min(nbrBlocks, mask + 1 - counter)
+            for value in range(prefix + counter, prefix + counter + count):
+                pack(out, offset, value >> 64, value & 0xffffffffffffffff)
+                offset += 16
+            nbrBlocks -= count
+            counter += count
+            if self.wrap:
+                counter &= mask
+        self.counter = counter
+        return out
+
+# chunks smaller than this are not worth sending to another process (ctrCryptParallel, decryptParallel)
+CTR_MIN_CHUNK = 64 * 1024
+
+def _splitChunks(n, workers, skip=0):
+    """
+    Splits n bytes into one chunk per worker (but not smaller than CTR_MIN_CHUNK).
+    Returns a list of (start, end). All chunks except the first start at a multiple
+    of 16 bytes after skip bytes.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunkSize = max(-(-n // workers), CTR_MIN_CHUNK)
+    chunkSize += -chunkSize % 16
+    starts = list(range(chunkSize - skip, n, chunkSize))
+    return list(zip([0] + starts, starts + [n]))
+
+def _runParallel(function, jobs, workers, executor):
+    """Runs function for the arguments of every job in a process pool, returns the results in order"""
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(min(workers or os.cpu_count() or 1, len(jobs)))
+    try:
+        futures = [executor.submit(function, *job) for job in jobs]
+        return [future.result() for future in futures]
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+
+def _ctrWorker(data, key, size, IV, offset, counterBits):
+    # runs in a worker process of ctrCryptParallel
+    moo = AESModeOfOperation()
+    moo.counterBits = counterBits
+    return moo.ctrCrypt(data, key, size, IV, offset)
+
+def _decryptWorker(data, previous, mode, key, size):
+    # runs in a worker process of decryptParallel
+    if mode == AESModeOfOperation.modeOfOperation["CBC"]:
+        return _cbcDecrypt(aes.getAESKey(key, size), data, previous)
+    return _cfbDecrypt(aes.getAESKey(key, size), data, previous)
+
+def _cbcEncrypt(aesKey, buf, previous):
+    """CBC encrypts the blocks of the bytearray buf in place.
+    previous is the previous ciphertext block (the IV for the first block)."""
+    unpack = _BLOCK.unpack_from
+    pack = _BLOCK.pack_into
+    encryptWords = aesKey.encryptWords
+    f0, f1, f2, f3 = unpack(previous, 0)
+    for offset in range(0, len(buf), 16):
+        p0, p1, p2, p3 = unpack(buf, offset)
+        f0, f1, f2, f3 = encryptWords(p0 ^ f0, p1 ^ f1, p2 ^ f2, p3 ^ f3)
+        pack(buf, offset, f0, f1, f2, f3)
+
+def _cfbEncrypt(aesKey, buf, previous):
+    """CFB encrypts the blocks of the bytearray buf in place.
+    previous is the previous ciphertext block (the IV for the first block)."""
+    unpack = _BLOCK.unpack_from
+    pack = _BLOCK.pack_into
+    encryptWords = aesKey.encryptWords
+    f0, f1, f2, f3 = unpack(previous, 0)
+    for offset in range(0, len(buf), 16):
+        k0, k1, k2, k3 = encryptWords(f0, f1, f2, f3)
+        p0, p1, p2, p3 = unpack(buf, offset)
+        f0, f1, f2, f3 = p0 ^ k0, p1 ^ k1, p2 ^ k2, p3 ^ k3
+        pack(buf, offset, f0, f1, f2, f3)
+
+def _previousBlocks(data, previous):
+    """Returns the block before every block of data: previous followed by all but the last block"""
+    nbrBlocks = (len(data) + 15) // 16
+    feedback = bytearray(16 * nbrBlocks)
+    if nbrBlocks:
+        feedback[0:16] = previous
+        feedback[16:] = memoryview(data)[:16 * nbrBlocks - 16]
+    return feedback
+
+# For decryption, all ciphertext blocks are known in advance,
+# so all blocks of CBC and CFB can be decrypted at once by the block engine.
+def _cbcDecrypt(aesKey, data, previous, out=None):
+    """CBC decrypts data, previous is the ciphertext block before data (the IV for the first block).
+    If out (a writable 'B' memoryview of len(data) bytes) is given, the plaintext is written into out."""
+    n = len(data)
+    if n % 16:
+        raise ValueError("CBC ciphertext length %d is not a multiple of 16" % n)
+    if out is None:
+        return _xorBytes(aesKey.decrypt_blocks(data), _previousBlocks(data, previous), n)
+    if n:
+        aesKey.decrypt_blocks(data, out=out)
+        with memoryview(data) as src, src.cast('B') as ciphertext:
+            _xorInto(out, out, previous, 16)
+            _xorInto(out[16:], out[16:], ciphertext, n - 16)
+    return out
+
+def _cfbDecrypt(aesKey, data, previous, out=None):
+    """CFB decrypts data, previous is the ciphertext block before data (the IV for the first block).
+    If out (a writable 'B' memoryview of len(data) bytes) is given, the plaintext is written into out."""
+    feedback = _previousBlocks(data, previous)
+    keystream = aesKey.encrypt_blocks(feedback, out=feedback)
+    if out is None:
+        return _xorBytes(data, keystream, len(data))
+    _xorInto(out, data, keystream, len(data))
+    return out
+
+class Encryptor(object):
+    """Encrypts a message chunk by chunk, at constant memory.
+
+    Call update() for every chunk of the message, and finalize() at the end.
+    Both return the ciphertext that is ready. Partial blocks are kept until
+    more data arrives or until finalize(). The state (the previous ciphertext
+    block, the counter, ...) is kept between the calls.
+    The ciphertext is the same as the result of AESModeOfOperation.encrypt for
+    the whole message, except for padding: with padding (the default for CBC and
+    ECB), PKCS7 padding is added by finalize().
+    """
+
+    def __init__(self, mode, key, size, IV, padding=None, counterBits=32):
+        modes = AESModeOfOperation.modeOfOperation
+        if mode not in modes.values():
+            raise ValueError("unknown mode of operation: %s" % mode)
+        if len(IV) < 16:
+            raise ValueError("the IV should be 16 bytes")
+        if padding is None:
+            padding = mode in (modes["CBC"], modes["ECB"])
+        if padding and mode not in (modes["CBC"], modes["ECB"]):
+            raise ValueError("padding is only used for CBC and ECB")
+        self.mode = mode
+        self.padding = padding
+        self._aesKey = aes.getAESKey(key, size)
+        self._IV = bytes(IV[0:16])
+        # CBC, CFB: the previous ciphertext block, OFB: the previous keystream block
+        self._feedback = self._IV
+        # CTR: the next counter block
+        self._counter = CounterBlock(self._IV, counterBits)
+        self._buffer = bytearray()
+        self._finalized = False
+
+    def update(self, chunk):
+        """Processes the next chunk, returns the output for all complete blocks"""
+        if self._finalized:
+            raise ValueError("update() called after finalize()")
+        self._buffer += chunk
+        n = self._ready()
+        if n == 0:
+            return b''
+        data = self._buffer[:n]
+        del self._buffer[:n]
+        return self._process(data)
+
+    def finalize(self):
+        """Processes the rest of the data (including padding), returns the last output"""
+        if self._finalized:
+            raise ValueError("finalize() called twice")
+        self._finalized = True
+        data = self._buffer
+        self._buffer = bytearray()
+        return self._final(data)
+
+    def _ready(self):
+        # the number of bytes that can be processed now: all complete blocks
+        return len(self._buffer) - len(self._buffer) % 16
+
+    def _final(self, data):
+        modes = AESModeOfOperation.modeOfOperation
+        if self.padding:
+            data = bytearray(aes.append_PKCS7_padding(data))
+        elif len(data) % 16 and self.mode in (modes["CBC"], modes["ECB"]):
+            raise ValueError("the data length is not a multiple of the block size, use padding")
+        return self._process(data)
+
+    def _process(self, data):
+        modes = AESModeOfOperation.modeOfOperation
+        aesKey = self._aesKey
+        n = len(data)
+        if self.mode == modes["CBC"]:
+            _cbcEncrypt(aesKey, data, self._feedback)
+            self._feedback = bytes(data[-16:])
+            return bytes(data)
+        if self.mode == modes["ECB"]:
+            return bytes(aesKey.encrypt_blocks(data, out=data))
+        if self.mode == modes["CFB"]:
+            data += bytes(-n % 16)
+            _cfbEncrypt(aesKey, data, self._feedback)
+            self._feedback = bytes(data[-16:])
+            return bytes(data[:n])
+        return _xorBytes(data, self._keystream(n), n)
+
+    def _keystream(self, n):
+        # OFB and CTR: encryption and decryption are the same
+        nbrBlocks = (n + 15) // 16
+        if self.mode == AESModeOfOperation.modeOfOperation["OFB"]:
+            keystream = AESModeOfOperation().ofbKeystream(self._aesKey, self._feedback, nbrBlocks)
+            self._feedback = bytes(keystream[-16:])
+        else:
+            counters = self._counter.fill(nbrBlocks)
+            keystream = self._aesKey.encrypt_blocks(counters, out=counters)
+        return keystream
+
+class Decryptor(Encryptor):
+    """Decrypts a message chunk by chunk, at constant memory.
+
+    See Encryptor. With padding, the last complete block is kept until finalize(),
+    because only then it is known that it is the block with the padding.
+    """
+
+    def _ready(self):
+        n = len(self._buffer) - len(self._buffer) % 16
+        if self.padding and n == len(self._buffer):
+            n -= 16
+        return max(n, 0)
+
+    def _final(self, data):
+        modes = AESModeOfOperation.modeOfOperation
+        if len(data) % 16 and self.mode in (modes["CBC"], modes["ECB"]):
+            raise ValueError("the ciphertext length is not a multiple of the block size")
+        data = self._process(data)
+        if self.padding:
+            data = aes.strip_PKCS7_padding(data)
+        return data
+
+    def _process(self, data):
+        modes = AESModeOfOperation.modeOfOperation
+        aesKey = self._aesKey
+        if self.mode == modes["CBC"]:
+            out = _cbcDecrypt(aesKey, data, self._feedback)
+        elif self.mode == modes["ECB"]:
+            return bytes(aesKey.decrypt_blocks(data, out=data))
+        elif self.mode == modes["CFB"]:
+            out = _cfbDecrypt(aesKey, data, self._feedback)
+        else:
+            return _xorBytes(data, self._keystream(len(data)), len(data))
+        if data:
+            self._feedback = bytes(data[-16:])
+        return out
+
+#
+# GCM: Galois/Counter Mode, an authenticated mode of operation.
+#
+# The data is encrypted with CTR, and the additional authenticated data (AAD) and the ciphertext
+# are authenticated with GHASH: a polynomial evaluation in GF(2^128) with the hash key H = E(K, 0^128).
+# The authentication tag is GHASH(AAD, ciphertext, lengths) XORed with the encryption of the first
+# counter block J0.
+#
+# GHASH multiplies by the same H for every block. Instead of a bit-by-bit multiplication,
+# the multiplication by H is done with 16 tables of 256 entries (one table for every byte of
+# the input): table i, entry b is the product of H and the byte b at position i.
+# Since the multiplication is linear, X * H is the XOR of the 16 table entries for the bytes of X.
+#
+class GHASH(object):
+    """GHASH with hash key H (16 bytes), with precomputed 8-bit multiplication tables"""
+
+    # the reduction polynomial x^128 + x^7 + x^2 + x + 1, in the bit order of GCM
+    R = 0xe1 << 120
+
+    def __init__(self, H, tables=None):
+        # the tables only depend on H, they can be shared by all GHASH objects of a key
+        self.tables = self.multiplicationTables(H) if tables is None else tables
+        self.Y = 0
+        self._buffer = b''
+
+    @classmethod
+    def multiplicationTables(cls, H):
+        """Returns the 16 tables of the multiplication by H"""
+        # V[k] = H * x^k, in GCM bit order the bit for x^0 is the most significant bit
+        v = int.from_bytes(H, 'big')
+        V = []
+        for k in range(128):
+            V.append(v)
+            v = (v >> 1) ^ cls.R if v & 1 else v >> 1
+        tables = []
+        for i in range(16):
+            table = [0] * 256
+            mask = 1
+            # bit mask of byte i stands for x^(8*i + 7 - log2(mask))
+            for j in range(7, -1, -1):
+                for b in range(mask):
+                    table[b | mask] = table[b] ^ V[8*i + j]
+                mask <<= 1
+            tables.append(tuple(table))
+        return tuple(tables)
+
+    def multiply(self, x):
+        """Returns x * H, with x and the result as 128-bit numbers"""
+        result = 0
+        for table, byte in zip(self.tables, x.to_bytes(16, 'big')):
+            result ^= table[byte]
+        return result
+
+    def update(self, data):
+        """Adds data to the hash. Partial blocks are kept until more data arrives or until pad()"""
+        if self._buffer:
+            data = self._buffer + bytes(data)
+        n = len(data) - len(data) % 16
+        multiply = self.multiply
+        Y = self.Y
+        with memoryview(data) as view:
+            for offset in range(0, n, 16):
+                Y = multiply(Y ^ int.from_bytes(view[offset:offset+16], 'big'))
+            self._buffer = bytes(view[n:])
+        self.Y = Y
+
+    def pad(self):
+        """Completes the last partial block with zeros"""
+        if self._buffer:
+            self.update(bytes(16 - len(self._buffer)))
+
+    def digest(self):
+        self.pad()
+        return self.Y.to_bytes(16, 'big')
+
+def ghashTables(aesKey):
+    """Returns the GHASH tables of an AESKey, for the hash key H = E(K, 0^128)"""
+    if aesKey.ghashTables is None:
+        aesKey.ghashTables = GHASH.multiplicationTables(aesKey.encrypt(bytes(16)))
+    return aesKey.ghashTables
+
+class GCMEncryptor(object):
+    """AES-GCM encryption, chunk by chunk.
+
+    The additional authenticated data can be given to the constructor, or with
+    update_aad() before the first call to update(). update() returns the ciphertext
+    of every chunk, finalize() returns the rest of the ciphertext. After finalize(),
+    the authentication tag is in the attribute tag.
+    """
+
+    def __init__(self, key, iv, aad=b'', size=None, tagLength=16):
+        if size is None:
+            size = len(key)
+        if not 12 <= tagLength <= 16:
+            raise ValueError("the tag length should be between 12 and 16 bytes")
+        if len(iv) == 0:
+            raise ValueError("the IV can't be empty")
+        self._aesKey = aes.getAESKey(key, size)
+        tables = ghashTables(self._aesKey)
+        self._ghash = GHASH(None, tables)
+        iv = bytes(iv)
+        if len(iv) == 12:
+            self._J0 = iv + b'\0\0\0\1'
+        else:
+            # other IV lengths: J0 = GHASH(IV, padded with zeros, followed by the bit length of the IV)
+            ghash = GHASH(None, tables)
+            ghash.update(iv)
+            ghash.pad()
+            ghash.update(struct.pack('>QQ', 0, 8 * len(iv)))
+            self._J0 = ghash.digest()
+        # the counter blocks are J0 incremented by 1, 2, ... in the last 32 bits (inc32)
+        self._counter = CounterBlock(self._J0, 32, int.from_bytes(self._J0[12:], 'big') + 1, wrap=True)
+        self.tagLength = tagLength
+        self.tag = None
+        self._aadLength = 0
+        self._length = 0
+        self._buffer = bytearray()
+        self._finalized = False
+        # set by the first update() or finalize(): the AAD is padded and complete
+        self._aadClosed = False
+        self.update_aad(aad)
+
+    def update_aad(self, aad):
+        """Adds additional authenticated data, only allowed before the first update()"""
+        if self._aadClosed:
+            raise ValueError("the AAD should be given before the data")
+        self._ghash.update(aad)
+        self._aadLength += len(aad)
+
+    def update(self, chunk):
+        if self._finalized:
+            raise ValueError("update() called after finalize()")
+        self._closeAAD()
+        self._buffer += chunk
+        n = len(self._buffer) - len(self._buffer) % 16
+        if n == 0:
+            return b''
+        data = self._buffer[:n]
+        del self._buffer[:n]
+        return self._process(data)
+
+    def finalize(self):
+        if self._finalized:
+            raise ValueError("finalize() called twice")
+        self._closeAAD()
+        out = self._process(self._buffer)
+        self._buffer = bytearray()
+        self._finalized = True
+        self._ghash.pad()
+        self._ghash.update(struct.pack('>QQ', 8 * self._aadLength, 8 * self._length))
+        self.tag = _xorBytes(self._ghash.digest(), self._aesKey.encrypt(self._J0), self.tagLength)
+        return out
 
-    `key` should be a string of bytes.
+    def _closeAAD(self):
+        if not self._aadClosed:
+            # the AAD is padded to complete blocks
+            self._ghash.pad()
+            self._aadClosed = True
 
-    returned cipher is a string of bytes prepended with the initialization
-    vector.
+    def _keystream(self, n):
+        counters = self._counter.fill((n + 15) // 16)
+        return self._aesKey.encrypt_blocks(counters, out=counters)
 
+    def _process(self, data):
+        out = _xorBytes(data, self._keystream(len(data)), len(data))
+        self._ghash.update(out)
+        self._length += len(data)
+        return out
+
+class GCMDecryptor(GCMEncryptor):
+    """AES-GCM decryption, chunk by chunk.
+
+    finalize(tag) checks the authentication tag and raises ValueError if it is wrong.
+    The plaintext returned by update() should not be used before finalize() succeeded.
     """
-    key = map(ord, key)
+
+    def finalize(self, tag):
+        if len(tag) != self.tagLength:
+            raise ValueError("invalid authentication tag length")
+        out = GCMEncryptor.finalize(self)
+        if not hmac.compare_digest(self.tag, bytes(tag)):
+            raise ValueError("invalid authentication tag")
+        return out
+
+    def _process(self, data):
+        out = _xorBytes(data, self._keystream(len(data)), len(data))
+        # the ciphertext is authenticated
+        self._ghash.update(data)
+        self._length += len(data)
+        return out
+
+def encryptGCM(plaintext, key, iv, aad=b'', size=None):
+    """encrypt `plaintext` with AES-GCM, returns the ciphertext and the authentication tag"""
+    encryptor = GCMEncryptor(key, iv, aad, size)
+    ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+    return ciphertext, encryptor.tag
+
+def decryptGCM(ciphertext, tag, key, iv, aad=b'', size=None):
+    """decrypt `ciphertext` with AES-GCM, raises ValueError if the tag is not valid"""
+    decryptor = GCMDecryptor(key, iv, aad, size, len(tag))
+    plaintext = decryptor.update(ciphertext)
+    return plaintext + decryptor.finalize(tag)
+
+#
+# XTS: the mode of operation for encrypted storage (IEEE 1619).
+#
+# Every sector (data unit) is encrypted on its own, so any sector can be read or written
+# without touching the other sectors. The key is the concatenation of two AES keys:
+# the second key encrypts the sector number into the tweak T, and every block j of the sector
+# is encrypted as E(K1, P xor T_j) xor T_j, with T_j = T * alpha^j in GF(2^128).
+# A last partial block is handled by ciphertext stealing.
+#
+def _numpyTweaks(t, nbrBlocks):
+    """Returns the tweaks t * alpha^j for j < nbrBlocks, computed with numpy"""
+    numpy = aes.numpy
+    # the tweaks as rows of 32: the first tweak of every row with Python integers,
+    # t * alpha^(32r): shift left by 32, reduce the 32 bits that fall out
+    rows = []
+    for r in range((nbrBlocks + 31) // 32):
+        rows.append(t)
+        high = t >> 96
+        t = ((t << 32) & 0xffffffffffffffffffffffffffffffff) ^ high ^ (high << 1) ^ (high << 2) ^ (high << 7)
+    # (rows, 32, 2): the low and the high 64 bits of every tweak
+    tweaks = numpy.zeros((len(rows), 32, 2), dtype=numpy.uint64)
+    tweaks[:, 0, 0] = [row & 0xffffffffffffffff for row in rows]
+    tweaks[:, 0, 1] = [row >> 64 for row in rows]
+    # the other columns in 5 steps: columns n..2n-1 are columns 0..n-1 times alpha^n
+    n = 1
+    while n < 32:
+        low, high = tweaks[:, :n, 0], tweaks[:, :n, 1]
+        shift, back = numpy.uint64(n), numpy.uint64(64 - n)
+        carry = high >> back
+        tweaks[:, n:2*n, 1] = (high << shift) | (low >> back)
+        tweaks[:, n:2*n, 0] = ((low << shift) ^ carry ^ (carry << numpy.uint64(1)) ^
+                               (carry << numpy.uint64(2)) ^ (carry << numpy.uint64(7)))
+        n *= 2
+    return bytearray(tweaks.astype('<u8').tobytes()[:16 * nbrBlocks])
+
+class XTS(object):
+    """XTS-AES with a key of 32 bytes (XTS-AES-128) or 64 bytes (XTS-AES-256)"""
+
+    def __init__(self, key, size=None):
+        if size is None:
+            size = len(key) // 2
+        if len(key) != 2 * size:
+            raise ValueError("the XTS key should be two AES keys of %d bytes" % size)
+        if size not in (16, 32):
+            # IEEE 1619: XTS-AES-128 or XTS-AES-256, there is no XTS-AES-192
+            raise ValueError("the XTS key should be 32 or 64 bytes, not %d" % len(key))
+        key = bytes(key)
+        if hmac.compare_digest(key[:size], key[size:]):
+            # IEEE 1619-2018, 5.1: Key1 and Key2 should be different
+            raise ValueError("the two halves of the XTS key should be different")
+        # both key schedules come from the key cache
+        self._aesKey = aes.getAESKey(key[:size], size)
+        self._tweakKey = aes.getAESKey(key[size:], size)
+
+    def tweaks(self, sectorNumber, nbrBlocks):
+        """Returns the tweaks T_0 .. T_(nbrBlocks-1) of a sector, as one buffer"""
+        t = int.from_bytes(self._tweakKey.encrypt(sectorNumber.to_bytes(16, 'little')), 'little')
+        if aes.blockEngine == "numpy" and nbrBlocks >= aes.NUMPY_MIN_BLOCKS:
+            return _numpyTweaks(t, nbrBlocks)
+        tweaks = bytearray(16 * nbrBlocks)
+        for offset in range(0, 16 * nbrBlocks, 16):
+            struct.pack_into('<QQ', tweaks, offset, t & 0xffffffffffffffff, t >> 64)
+            # multiplication by alpha: shift left, reduce by x^128 + x^7 + x^2 + x + 1
+            t = ((t << 1) & 0xffffffffffffffffffffffffffffffff) ^ (0x87 if t >> 127 else 0)
+        return tweaks
+
+    def _blocks(self, data, tweaks, decrypt):
+        # XOR with the tweaks, encrypt (or decrypt) all blocks at once, XOR with the tweaks again
+        buf = bytearray(_xorBytes(data, tweaks, len(data)))
+        if decrypt:
+            self._aesKey.decrypt_blocks(buf, out=buf)
+        else:
+            self._aesKey.encrypt_blocks(buf, out=buf)
+        return _xorBytes(buf, tweaks, len(data))
+
+    def encrypt_sector(self, data, sectorNumber):
+        """Encrypts one sector (at least 16 bytes) with the given sector number"""
+        return self._sector(data, sectorNumber, False)
+
+    def decrypt_sector(self, data, sectorNumber):
+        """Decrypts one sector (at least 16 bytes) with the given sector number"""
+        return self._sector(data, sectorNumber, True)
+
+    def _sector(self, data, sectorNumber, decrypt):
+        n = len(data)
+        if n < 16:
+            raise ValueError("an XTS sector should be at least 16 bytes")
+        partial = n % 16
+        full = n - partial
+        tweaks = self.tweaks(sectorNumber, (n + 15) // 16)
+        with memoryview(data) as view, memoryview(tweaks) as tweakView:
+            if not partial:
+                return self._blocks(view, tweakView, decrypt)
+            # ciphertext stealing: the last complete block and the partial block
+            last = full - 16
+            out = self._blocks(view[:last], tweakView[:last], decrypt)
+            # when decrypting, the tweaks of the last two blocks are swapped
+            first, second = (tweakView[full:], tweakView[last:full]) if decrypt else \
+                            (tweakView[last:full], tweakView[full:])
+            CC = self._blocks(view[last:full], first, decrypt)
+            PP = bytes(view[full:]) + CC[partial:]
+            return out + self._blocks(PP, second, decrypt) + CC[:partial]
+
+
+# The format of encryptData: a header with the mode and the key size (1 byte each),
+# the IV (16 bytes) and the ciphertext. Only CBC uses (PKCS7) padding.
+_DATA_HEADER = struct.Struct('>BB')
+DATA_OVERHEAD = _DATA_HEADER.size + 16
+
+def encryptedDataSize(length, mode=AESModeOfOperation.modeOfOperation["CBC"]):
+    """the number of bytes encryptData returns for `length` bytes of data"""
     if mode == AESModeOfOperation.modeOfOperation["CBC"]:
-        data = append_PKCS7_padding(data)
+        length += 16 - length % 16
+    return DATA_OVERHEAD + length
+
+def encryptData(key, data, mode=AESModeOfOperation.modeOfOperation["CBC"], out=None):
+    """encrypt `data` using `key`
+
+    `key` and `data` should be bytes-like objects. The modes OFB, CFB, CBC and CTR
+    are supported.
+
+    returned cipher is bytes: a header with the mode and the key size, followed by
+    a random initialization vector and the ciphertext.
+    If `out` (a writable buffer of at least encryptedDataSize bytes) is given, the
+    cipher is written into `out` and the number of bytes written is returned.
+
+    """
+    modes = AESModeOfOperation.modeOfOperation
     keysize = len(key)
-    assert keysize in AES.keySize.values(), 'invalid key size: %s' % keysize
+    if keysize not in aes.AES.keySize.values():
+        raise ValueError('invalid key size: %s' % keysize)
+    if mode not in (modes["OFB"], modes["CFB"], modes["CBC"], modes["CTR"]):
+        raise ValueError('mode %s is not supported by encryptData' % mode)
     # create a new iv using random data
-    iv = [ord(i) for i in os.urandom(16)]
-    moo = AESModeOfOperation()
-    (mode, length, ciph) = moo.encrypt(data, mode, key, keysize, iv)
-    # With padding, the original length does not need to be known. It's a bad
-    # idea to store the original message length.
-    # prepend the iv.
-    return ''.join(map(chr, iv)) + ''.join(map(chr, ciph))
+    iv = os.urandom(16)
+    size = encryptedDataSize(len(data), mode)
+    result = bytearray(size) if out is None else out
+    with memoryview(result) as view, view.cast('B') as buf:
+        if len(buf) < size:
+            raise ValueError('output buffer is too small: %d < %d' % (len(buf), size))
+        _DATA_HEADER.pack_into(buf, 0, mode, keysize)
+        buf[2:DATA_OVERHEAD] = iv
+        # With padding (CBC), the original length does not need to be known. It's a bad
+        # idea to store the original message length.
+        encryptor = Encryptor(mode, key, keysize, iv)
+        ciphertext = encryptor.update(data)
+        end = DATA_OVERHEAD + len(ciphertext)
+        buf[DATA_OVERHEAD:end] = ciphertext
+        buf[end:size] = encryptor.finalize()
+    if out is None:
+        return bytes(result)
+    return size
 
-def decryptData(key, data, mode=AESModeOfOperation.modeOfOperation["CBC"]):
+def decryptData(key, data, mode=None, out=None):
     """decrypt `data` using `key`
 
-    `key` should be a string of bytes.
+    `key` and `data` should be bytes-like objects, `data` as returned by encryptData.
+    The mode and the key size are read from the header of `data`. If `mode` is given,
+    it should be the same as the mode in the header.
 
-    `data` should have the initialization vector prepended as a string of
-    ordinal values.
+    returns the plaintext as bytes. If `out` is given, the plaintext is decrypted
+    directly into `out` and its length is returned. `out` should be a writable buffer
+    of at least len(data) - DATA_OVERHEAD bytes: with CBC, the padding is written too.
 
     """
+    modes = AESModeOfOperation.modeOfOperation
+    if len(data) < DATA_OVERHEAD:
+        raise ValueError('data is too short: %d bytes' % len(data))
+    with memoryview(data) as view, view.cast('B') as buf:
+        dataMode, keysize = _DATA_HEADER.unpack_from(buf, 0)
+        if mode is not None and mode != dataMode:
+            raise ValueError('data was encrypted with mode %s, not %s' % (dataMode, mode))
+        if dataMode not in (modes["OFB"], modes["CFB"], modes["CBC"], modes["CTR"]):
+            raise ValueError('mode %s is not supported by decryptData' % dataMode)
+        if keysize != len(key):
+            raise ValueError('data was encrypted with a key of %d bytes' % keysize)
+        aesKey = aes.getAESKey(key, keysize)
+        # iv follows the header
+        iv = bytes(buf[2:DATA_OVERHEAD])
+        body = buf[DATA_OVERHEAD:]
+        n = len(body)
+        # the plaintext is computed in the output buffer
+        result = bytearray(n) if out is None else out
+        with memoryview(result) as resultView, resultView.cast('B') as target:
+            if target.readonly:
+                raise ValueError('output buffer is read-only')
+            if len(target) < n:
+                raise ValueError('output buffer is too small: %d < %d' % (len(target), n))
+            plain = target[:n]
+            length = n
+            if dataMode == modes["CBC"]:
+                _cbcDecrypt(aesKey, body, iv, out=plain)
+                # only the last block has padding
+                length = n - 16 + len(aes.strip_PKCS7_padding(bytes(plain[-16:])))
+            elif dataMode == modes["CFB"]:
+                _cfbDecrypt(aesKey, body, iv, out=plain)
+            else:
+                nbrBlocks = (n + 15) // 16
+                if dataMode == modes["CTR"]:
+                    keystream = AESModeOfOperation().ctrKeystream(aesKey, iv, nbrBlocks)
+                else:
+                    keystream = AESModeOfOperation().ofbKeystream(aesKey, iv, nbrBlocks)
+                _xorInto(plain, body, keystream, n)
+            plain.release()
+        body.release()
+    if out is None:
+        del result[length:]
+        return bytes(result)
+    return length
 
-    key = map(ord, key)
-    keysize = len(key)
-    assert keysize in AES.keySize.values(), 'invalid key size: %s' % keysize
-    # iv is first 16 bytes
-    iv = map(ord, data[:16])
-    data = map(ord, data[16:])
-    moo = AESModeOfOperation()
-    decr = moo.decrypt(data, None, mode, key, keysize, iv)
-    if mode == AESModeOfOperation.modeOfOperation["CBC"]:
-        decr = strip_PKCS7_padding(decr)
-    return decr
+# the number of bytes of a file that are processed at once by encrypt_file/decrypt_file
+FILE_WINDOW = 4 * 1024 * 1024
+
+def encrypt_file(src, dst, key, mode, iv, size=None, padding=None, window=FILE_WINDOW):
+    """encrypt the file `src` into the file `dst`
+
+    The input file is memory-mapped and processed in windows of `window` bytes
+    by an Encryptor, so the whole file is never in memory.
+    `padding` is as for Encryptor (PKCS7 padding is the default for CBC and ECB).
+    The output is written to a temporary file that replaces `dst` only when
+    all went well, so `src` and `dst` can be the same file.
+    Returns the number of bytes written to `dst`.
+
+    """
+    if size is None:
+        size = len(key)
+    return _processFile(Encryptor(mode, key, size, iv, padding), src, dst, window)
+
+def decrypt_file(src, dst, key, mode, iv, size=None, padding=None, window=FILE_WINDOW):
+    """decrypt the file `src` into the file `dst`, see encrypt_file"""
+    if size is None:
+        size = len(key)
+    return _processFile(Decryptor(mode, key, size, iv, padding), src, dst, window)
+
+def _processFile(cipher, src, dst, window):
+    window += -window % 16
+    written = 0
+    with open(src, 'rb') as fin:
+        fd, temporary = _temporaryFile(dst)
+        try:
+            with open(fd, 'wb', buffering=window) as fout:
+                length = os.fstat(fin.fileno()).st_size
+                if length:
+                    with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as data, memoryview(data) as view:
+                        for start in range(0, length, window):
+                            written += fout.write(cipher.update(view[start:start+window]))
+                written += fout.write(cipher.finalize())
+        except BaseException:
+            os.unlink(temporary)
+            raise
+    # src is closed: dst can be src
+    try:
+        if os.path.exists(dst):
+            shutil.copymode(dst, temporary)
+        os.replace(temporary, dst)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return written
+
+def _temporaryFile(dst):
+    """Creates a new file next to dst, with the permissions of a new file (0o666 without the umask).
+    Returns the file descriptor and the name."""
+    directory, name = os.path.split(os.path.abspath(dst))
+    while True:
+        temporary = os.path.join(directory, '.%s.%s.tmp' % (name, secrets.token_hex(4)))
+        try:
+            return os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), temporary
+        except FileExistsError:
+            pass
 
 def generateRandomKey(keysize):
     """Generates a key from random data of length `keysize`.
@@ -370,7 +1136,7 @@ def generateRandomKey(keysize):
     return os.urandom(keysize)
 
 if __name__ == "__main__":
-    import secrets
+    import tempfile
 
     moo = AESModeOfOperation()
     cleartext = "This is a test! This is a test! This is a test!"
@@ -536,3 +1302,157 @@ if __name__ == "__main__":
     decr = moo.decrypt(ciph, orig_len, mode, cipherkey,
             moo.aes.keySize["SIZE_256"], iv)
     assert decr == cleartext
+
+    moo = AESModeOfOperation()
+    cleartext = b"This is a test! This is a test! This is a test!"
+    cipherkey = secrets.token_bytes(16)
+    mode, orig_len, ciph = moo.encrypt(cleartext, moo.modeOfOperation["ECB"],
+            cipherkey, moo.aes.keySize["SIZE_128"], bytes(16))
+    # ECB: equal plaintext blocks give equal ciphertext blocks
+    assert ciph[0:16] == ciph[16:32]
+    decr = moo.decrypt(ciph, orig_len, mode, cipherkey,
+            moo.aes.keySize["SIZE_128"], bytes(16))
+    assert decr == cleartext
+
+    # Encryptor and Decryptor process a message chunk by chunk
+    cleartext = secrets.token_bytes(1000)
+    cipherkey = secrets.token_bytes(16)
+    iv = secrets.token_bytes(16)
+    for mode in ("OFB", "CFB", "CTR"):
+        mode = moo.modeOfOperation[mode]
+        encryptor = moo.encryptor(mode, cipherkey, moo.aes.keySize["SIZE_128"], iv)
+        ciph = b''.join(encryptor.update(cleartext[i:i+77]) for i in range(0, 1000, 77))
+        ciph += encryptor.finalize()
+        assert ciph == moo.encrypt(cleartext, mode, cipherkey, moo.aes.keySize["SIZE_128"], iv)[2]
+    mode = moo.modeOfOperation["CBC"]
+    encryptor = moo.encryptor(mode, cipherkey, moo.aes.keySize["SIZE_128"], iv)
+    ciph = encryptor.update(cleartext) + encryptor.finalize()
+    decryptor = moo.decryptor(mode, cipherkey, moo.aes.keySize["SIZE_128"], iv)
+    decr = b''.join(decryptor.update(ciph[i:i+100]) for i in range(0, len(ciph), 100))
+    decr += decryptor.finalize()
+    assert decr == cleartext
+
+    # CTR: any part of the stream can be decrypted without the keystream before it
+    cleartext = secrets.token_bytes(1000)
+    mode, orig_len, ciph = moo.encrypt(cleartext, moo.modeOfOperation["CTR"],
+            cipherkey, moo.aes.keySize["SIZE_128"], iv)
+    decr = moo.ctrCrypt(ciph[555:700], cipherkey, moo.aes.keySize["SIZE_128"], iv, offset=555)
+    assert decr == cleartext[555:700]
+
+    # CTR counter block: only the counter is incremented, and an exhausted counter is an error
+    counter = CounterBlock(bytes([0xff]) * 16, 32, 2**32 - 2)
+    counters = counter.fill(2)
+    assert counters == bytes([0xff]) * 15 + bytes([0xfe]) + bytes([0xff]) * 16
+    try:
+        counter.fill(1)
+        assert False
+    except OverflowError:
+        pass
+    counter = CounterBlock(bytes(8), 64, 255)
+    counter.increment()
+    assert bytes(counter) == bytes(14) + bytes([1, 0])
+    # increment() and fill() use the last counter value the same way
+    counter = CounterBlock(bytes(12), 32, 2**32 - 1)
+    counter.increment()
+    assert counter.counter == 2**32
+    for exhausted in (counter.increment, lambda: bytes(counter), lambda: counter.fill(1)):
+        try:
+            exhausted()
+            assert False
+        except OverflowError:
+            pass
+
+    # GCM: authenticated encryption (test case 3 of the GCM specification)
+    cipherkey = bytes.fromhex('feffe9928665731c6d6a8f9467308308')
+    iv = bytes.fromhex('cafebabefacedbaddecaf888')
+    cleartext = bytes.fromhex('d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+                              '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b391aafd255')
+    ciph, tag = encryptGCM(cleartext, cipherkey, iv)
+    assert tag == bytes.fromhex('4d5c2af327cd64a62cf35abd2ba6fab4')
+    assert decryptGCM(ciph, tag, cipherkey, iv) == cleartext
+    # the GHASH tables are computed once per key, also for other IV lengths
+    assert GCMEncryptor(cipherkey, iv[:8])._ghash.tables is ghashTables(aes.getAESKey(cipherkey))
+    # no AAD after the first update(), not even after an empty one
+    encryptor = GCMEncryptor(cipherkey, iv)
+    encryptor.update(b'')
+    try:
+        encryptor.update_aad(b'x')
+        assert False
+    except ValueError:
+        pass
+
+    # XTS: every sector is encrypted on its own (vector 2 of IEEE 1619)
+    xts = XTS(bytes([0x11]) * 16 + bytes([0x22]) * 16)
+    ciph = xts.encrypt_sector(bytes([0x44]) * 32, 0x3333333333)
+    assert ciph == bytes.fromhex('c454185e6a16936e39334038acef838bfb186fff7480adc4289382ecd6d394f0')
+    assert xts.decrypt_sector(ciph, 0x3333333333) == bytes([0x44]) * 32
+    try:
+        XTS(bytes([0x11]) * 32)
+        assert False
+    except ValueError:
+        pass
+    try:
+        XTS(secrets.token_bytes(48))
+        assert False
+    except ValueError:
+        pass
+    if aes.numpy is not None:
+        # the numpy tweaks are the same as the tweaks computed one by one
+        engine = aes.blockEngine
+        for nbrBlocks in (16, 33, 256):
+            aes.setBlockEngine("table")
+            tweaks = xts.tweaks(0x3333333333, nbrBlocks)
+            aes.setBlockEngine("numpy")
+            assert xts.tweaks(0x3333333333, nbrBlocks) == tweaks
+        aes.setBlockEngine(engine)
+
+    # encryptData: random IV, the mode and the key size are stored with the ciphertext
+    cipherkey = secrets.token_bytes(32)
+    for mode in ("OFB", "CFB", "CBC", "CTR"):
+        ciph = encryptData(cipherkey, b"This is a test! This is a test!", moo.modeOfOperation[mode])
+        assert decryptData(cipherkey, ciph) == b"This is a test! This is a test!"
+    # with out, the plaintext is decrypted in the output buffer, with both block engines
+    engine = aes.blockEngine
+    for engineName in ("table", "numpy") if aes.numpy is not None else ("table",):
+        aes.setBlockEngine(engineName)
+        for mode in ("OFB", "CFB", "CBC", "CTR"):
+            for length in (0, 15, 16, 300):
+                cleartext = secrets.token_bytes(length)
+                ciph = bytearray(encryptedDataSize(length, moo.modeOfOperation[mode]))
+                assert encryptData(cipherkey, cleartext, moo.modeOfOperation[mode], out=ciph) == len(ciph)
+                target = bytearray(len(ciph) - DATA_OVERHEAD)
+                assert decryptData(cipherkey, ciph, out=target) == length
+                assert target[:length] == cleartext
+                assert decryptData(cipherkey, ciph) == cleartext
+    aes.setBlockEngine(engine)
+
+    # encrypt_file: the output replaces dst only when all went well, in place too
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "file")
+        other = os.path.join(directory, "other")
+        cleartext = secrets.token_bytes(1000)
+        with open(path, 'wb') as f:
+            f.write(cleartext)
+        os.chmod(path, 0o640)
+        encrypt_file(path, path, cipherkey, moo.modeOfOperation["CBC"], iv + bytes(4))
+        assert os.stat(path).st_mode & 0o777 == 0o640
+        decrypt_file(path, other, cipherkey, moo.modeOfOperation["CBC"], iv + bytes(4))
+        with open(other, 'rb') as f:
+            assert f.read() == cleartext
+        with open(path, 'ab') as f:
+            f.write(b'not a complete block')
+        try:
+            decrypt_file(path, other, cipherkey, moo.modeOfOperation["CBC"], iv + bytes(4))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a truncated block was decrypted")
+        with open(other, 'rb') as f:
+            assert f.read() == cleartext
+        assert sorted(os.listdir(directory)) == ["file", "other"]
+        # a missing input leaves no temporary file (and no open file descriptor)
+        try:
+            encrypt_file(os.path.join(directory, "missing"), other, cipherkey, moo.modeOfOperation["CBC"], iv + bytes(4))
+        except FileNotFoundError:
+            pass
+        assert sorted(os.listdir(directory)) == ["file", "other"]
@@ -22,10 +22,28 @@
 # from six import BytesIO
 from io import BytesIO
 
+import os
+import hmac
+import array
+import time
+import mmap
+import base64
 import struct
+import hashlib
 import binascii
+import platform
+import asyncio
+import functools
+import threading
 import multiprocessing
-import multiprocessing.dummy
+import multiprocessing.connection
+from multiprocessing import shared_memory
+import concurrent.futures
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, without it the pure Python compression function is used
+    numpy = None
 
 __all__ = [
     'argon2',
@@ -34,7 +52,24 @@ __all__ = [
     'ARGON2_DEFAULT_VERSION',
     'ARGON2_VERSIONS',
     'Argon2Error',
-    'Argon2ParameterError']
+    'Argon2ParameterError',
+    'argon2_many',
+    'Argon2Pool',
+    'POOL_MAX_MEMORY_COST',
+    'hash_encoded',
+    'verify',
+    'needs_rehash',
+    'decode_hash',
+    'calibrate',
+    'argon2_async',
+    'verify_async',
+    'Argon2Executor',
+    'Argon2QueueFull',
+    'address_stream',
+    'address_cache_info',
+    'address_cache_clear',
+    'set_compression_backend',
+    'set_blake2b_backend']
 
 ARGON2D  = 0
 ARGON2I  = 1
@@ -71,18 +106,53 @@ def argon2(password, salt, time_cost, memory_cost, parallelism,
     :param bytes associated_data: Optional associated data
     :param int type: variant of argon2 to use.  Either ARGON2I or ARGON2D
     :param int threads: number of threads to use to compute the hash.
-    :param bool use_threads: if true, signal multiprocessing to use threads
-        rather than processes.
+        With more than one, the matrix is in shared memory and the lanes
+        are filled by that many worker processes.
+    :param bool use_threads: if true, use threads rather than processes.
     :param int version: version of argon2 to use.  At the moment either
         0x10 for v1.0 or 0x13 for v1.3
 
     :rtype: bytes """
+    _check_parameters(time_cost, memory_cost, parallelism, type_code, version)
     if threads is None:
         threads = parallelism
-    if parallelism <= 0:
-        raise Argon2ParameterError("parallelism must be strictly positive")
     if threads <= 0:
         raise Argon2ParameterError("threads must be strictly positive")
+
+    threads = min(parallelism, threads)
+
+    H0 = _H0(password, salt, time_cost, memory_cost, parallelism, tag_length,
+             secret, associated_data, type_code, version)
+
+    m_prime = _m_prime(memory_cost, parallelism)
+    q = m_prime // parallelism  # lane_length
+
+    # The blocks in Argon2 are arranged in a matrix.  For each thread,
+    # there is a row, which is also called a lane.  The number of
+    # columns depends on the memory_cost.
+    # There will be time_cost passes over the whole matrix.
+    # The colums are put into groups of four, called slices.
+    # The intersection of a lane with a slice is called a segment.
+    # The matrix is filled one slice at the time.  The segments within
+    # a slice can be computed in parallel.
+    if threads > 1:
+        B_final = _fill_parallel(H0, time_cost, parallelism, m_prime,
+                                 type_code, version, threads, use_threads)
+        return _H_prime(B_final, tag_length)
+
+    # The whole matrix in one buffer, see `_fill_matrix'.
+    memory = _allocate_matrix(m_prime)
+    try:
+        _fill_matrix(memory, H0, time_cost, parallelism, m_prime,
+                     type_code, version)
+        return _H_prime(_final_block(memory, q, parallelism), tag_length)
+    finally:
+        if isinstance(memory, mmap.mmap):
+            memory.close()
+
+def _check_parameters(time_cost, memory_cost, parallelism, type_code, version):
+    if parallelism <= 0:
+        raise Argon2ParameterError("parallelism must be strictly positive")
     if time_cost <= 0:
         raise Argon2ParameterError("time_cost must be strictly positive")
     if memory_cost < 8 * parallelism:
@@ -93,18 +163,14 @@ def argon2(password, salt, time_cost, memory_cost, parallelism,
     if version not in ARGON2_VERSIONS:
         raise Argon2ParameterError("version %s not supported" % version)
 
-    threads = min(parallelism, threads)
-
-    if threads == 1:
-        worker_pool = None
-    else:
-        if use_threads:
-            Pool = multiprocessing.dummy.Pool
-        else:
-            Pool = multiprocessing.Pool
-        worker_pool = Pool(processes=threads)
+def _m_prime(memory_cost, parallelism):
+    """ The number of blocks: memory_cost rounded down to a multiple of
+    4 * parallelism. """
+    return (memory_cost // (4 * parallelism)) * (4 * parallelism)
 
-    # Compute the pre-hasing digest
+def _H0(password, salt, time_cost, memory_cost, parallelism, tag_length,
+        secret, associated_data, type_code, version):
+    """ The pre-hashing digest H0, see section 3.2 of the argon2 spec. """
     h = Blake2b()
     h.update(struct.pack("<iiiiii", parallelism,
                                     tag_length,
@@ -120,188 +186,877 @@ def argon2(password, salt, time_cost, memory_cost, parallelism,
     h.update(secret)
     h.update(struct.pack("<i", len(associated_data)))
     h.update(associated_data)
-    H0 = h.digest()
+    return h.digest()
 
-    m_prime = (memory_cost // (4 * parallelism)) * (4 * parallelism)
-    q = m_prime // parallelism  # lane_length
-    segment_length = q // 4
+def _reference(J1, J2, t, segment, index, i, segment_length, q, parallelism):
+    """ The lane and column of the reference block for column
+    segment * segment_length + index of lane i, in pass t. """
+    j = segment * segment_length + index
+    i_prime = i if t == 0 and segment == 0 else J2 % parallelism
 
-    # Allocate the matrix.
-    B = [[None for j in range(q)] for i in range(parallelism)]
+    if t == 0:
+        if segment == 0 or i == i_prime:
+            ref_area_size = j - 1
+        elif index == 0:
+            ref_area_size = segment * segment_length - 1
+        else:
+            ref_area_size = segment * segment_length
+    elif i == i_prime:  # same_lane
+        ref_area_size = q - segment_length + index - 1
+    elif index == 0:
+        ref_area_size = q - segment_length - 1
+    else:
+        ref_area_size = q - segment_length
 
-    # The blocks in Argon2 are arranged in a matrix.  For each thread,
-    # there is a row, which is also called a lane.  The number of
-    # columns depends on the memory_cost.
-    # There will be time_cost passes over the whole matrix.
-    # The colums are put into groups of four, called slices.
-    # The intersection of a lane with a slice is called a segment.
-    # The matrix is filled one slice at the time.  The segments within
-    # a slice can be computed in parallel.
+    rel_pos = (J1 ** 2) >> 32
+    rel_pos = ref_area_size - 1 - ((ref_area_size * rel_pos) >> 32)
+    start_pos = 0
+
+    if t != 0 and segment != 3:
+        start_pos = (segment + 1) * segment_length
+    return i_prime, (start_pos + rel_pos) % q
+
+# The matrix in one buffer.
+#
+# Instead of a list of lists of 1024 byte `bytes' objects, the whole matrix
+# is one bytearray of m_prime * 1024 bytes.  Block j of lane i starts at
+# byte offset (i * q + j) * 1024.  The compression function reads its inputs
+# as 128 64-bit words straight from the buffer and writes the result in place
+# into the slot of the new block, so filling the matrix allocates no blocks.
+# For large memory costs, the buffer is an anonymous mmap instead of a
+# bytearray: the pages are only committed when they are written, and they
+# are returned to the operating system as soon as the hash is done.
+
+MMAP_THRESHOLD = 64 * 1024 * 1024  # bytes
+
+_BLOCK_WORDS = struct.Struct('<128Q')
+
+def _allocate_matrix(m_prime):
+    """ A zeroed, writable buffer for m_prime blocks. """
+    if m_prime * 1024 >= MMAP_THRESHOLD:
+        return mmap.mmap(-1, m_prime * 1024)
+    return bytearray(m_prime * 1024)
+
+def _fill_matrix(memory, H0, time_cost, parallelism, m_prime, type_code,
+                 version):
+    """ Fills the matrix in *memory*, one slice at the time. """
+    q = m_prime // parallelism
+    segment_length = q // 4
     for t in range(time_cost):
         for segment in range(4):
-            if not worker_pool:
-                for i in range(parallelism):
-                    _fill_segment(B, t, segment, i, type_code, segment_length,
-                                H0, q, parallelism, m_prime, time_cost, version)
-                continue
-
-            handles = [None]*parallelism
-            for i in range(parallelism):
-                handles[i] = worker_pool.apply_async(_fill_segment,
-                            (B, t, segment, i, type_code, segment_length, H0,
-                                q, parallelism, m_prime, time_cost, version))
             for i in range(parallelism):
-                new_blocks = handles[i].get()
-                for index in range(segment_length):
-                    B[i][segment * segment_length + index] = new_blocks[index]
+                _fill_segment_into(memory, t, segment, i, type_code,
+                                   segment_length, H0, q, parallelism,
+                                   m_prime, time_cost, version)
 
-    if worker_pool:
-        # don't let workers sit around until pool is GC'd
-        worker_pool.close()
+def _final_block(memory, q, parallelism):
+    """ The XOR of the last blocks of all lanes. """
+    B_final = 0
+    for i in range(parallelism):
+        offset = (i * q + q - 1) * 1024
+        B_final ^= int.from_bytes(memory[offset:offset + 1024], 'little')
+    return B_final.to_bytes(1024, 'little')
 
-    B_final = b'\0' * 1024
+# Parallel lanes.
+#
+# With threads > 1, the matrix is in shared memory (multiprocessing.shared_memory,
+# or an ordinary buffer with use_threads), and every worker fills the segments of
+# its own lanes: worker w fills lanes w, w + threads, ...  A segment only refers
+# to blocks of earlier slices in the other lanes, so after every slice, the
+# workers wait at a barrier until all segments of the slice are done.  The
+# workers live for the whole computation and nothing is copied between them.
 
-    for i in range(parallelism):
-        B_final = xor1024(B_final, B[i][q-1])
+def _fill_parallel(H0, time_cost, parallelism, m_prime, type_code, version,
+                   threads, use_threads):
+    """ Fills the matrix with *threads* workers, returns the final block. """
+    q = m_prime // parallelism
+    args = (H0, time_cost, parallelism, m_prime, type_code, version)
+    if use_threads:
+        memory = _allocate_matrix(m_prime)
+        barrier = threading.Barrier(threads)
+        workers = [threading.Thread(target=_fill_lanes,
+                                    args=(memory, w, threads, barrier) + args)
+                   for w in range(threads)]
+        _run_workers(workers, barrier)
+        return _final_block(memory, q, parallelism)
+
+    shm = shared_memory.SharedMemory(create=True, size=m_prime * 1024)
+    try:
+        barrier = multiprocessing.Barrier(threads)
+        workers = [multiprocessing.Process(target=_fill_lanes_shared,
+                                        args=(shm.name, w, threads, barrier) + args)
+                   for w in range(threads)]
+        _run_processes(workers)
+        return _final_block(shm.buf, q, parallelism)
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _run_workers(workers, barrier):
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if barrier.broken:
+        raise Argon2Error("an argon2 worker failed")
+
+def _run_processes(workers):
+    """ Runs the worker processes.  As soon as one of them fails, also when
+    it is killed and can't abort the barrier, the others are terminated. """
+    for worker in workers:
+        worker.start()
+    try:
+        running = {worker.sentinel: worker for worker in workers}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                worker = running.pop(sentinel)
+                worker.join()
+                if worker.exitcode != 0:
+                    raise Argon2Error("an argon2 worker process failed"
+                                      " (exit code %s)" % worker.exitcode)
+    finally:
+        # a killed worker may hold the lock of the barrier, so the others
+        # are terminated instead of woken up with barrier.abort()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+def _fill_lanes(memory, worker, threads, barrier, H0, time_cost, parallelism,
+                m_prime, type_code, version):
+    """ The work of one worker: its lanes of every slice. """
+    q = m_prime // parallelism
+    segment_length = q // 4
+    try:
+        for t in range(time_cost):
+            for segment in range(4):
+                for i in range(worker, parallelism, threads):
+                    _fill_segment_into(memory, t, segment, i, type_code,
+                                       segment_length, H0, q, parallelism,
+                                       m_prime, time_cost, version)
+                barrier.wait()
+    except BaseException:
+        # don't let the other workers wait for this one forever
+        barrier.abort()
+        raise
+
+def _fill_lanes_shared(name, worker, threads, barrier, *args):
+    # runs in a worker process: the matrix is the shared memory *name*
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        _fill_lanes(shm.buf, worker, threads, barrier, *args)
+    finally:
+        shm.close()
+
+# Many hashes.
+#
+# argon2_many computes many hashes on a pool of worker processes that is
+# started once and reused for all later calls.  Every job is computed by one
+# worker, with the lanes one after the other: the parallelism is between the
+# jobs.  Every worker keeps its matrix between the jobs, so a job only
+# allocates memory when it needs more blocks than all jobs before it.  The
+# matrix doesn't have to be cleared: every block is written before it is read.
+# Jobs that need more than max_memory_cost kibibytes (POOL_MAX_MEMORY_COST by
+# default) are refused, so the workers never use more than
+# workers * max_memory_cost kibibytes together.  Without a limit
+# (max_memory_cost=None), a worker frees a matrix larger than
+# POOL_MAX_MEMORY_COST after its job instead of keeping it.
+# A job that fails doesn't stop the others: its result is the exception.
+
+POOL_MAX_MEMORY_COST = 64 * 1024  # kibibytes
+
+class Argon2Pool(object):
+    """ A pool of worker processes for `argon2_many'. """
+
+    def __init__(self, workers=None, max_memory_cost=POOL_MAX_MEMORY_COST):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 0:
+            raise Argon2ParameterError("workers must be strictly positive")
+        self.workers = workers
+        self.max_memory_cost = max_memory_cost
+        self._pool = multiprocessing.Pool(workers, initializer=_pool_init,
+                                          initargs=(max_memory_cost,))
+
+    def imap(self, jobs):
+        """ Yields (index, tag) for every job, as soon as it is done.
+        For a job that failed, the tag is the exception. """
+        results = self._pool.imap_unordered(_pool_hash, enumerate(jobs))
+        for index, tag in results:
+            yield index, tag
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+_default_pool = None
+
+def argon2_many(jobs, workers=None, max_memory_cost=POOL_MAX_MEMORY_COST,
+                pool=None):
+    """ Compute the Argon2 hashes of many *jobs*.
+
+    Every job is a tuple of positional arguments or a dict of keyword
+    arguments of `argon2' (except threads and use_threads).  Yields
+    (index, tag) for every job, in the order in which they are done.
+    The tag of a job that failed is the exception, e.g.
+    Argon2ParameterError for invalid parameters.
+
+    :param int workers: number of worker processes (default: the number
+        of CPUs).
+    :param int max_memory_cost: the largest memory_cost (in kibibytes)
+        of a job (default: POOL_MAX_MEMORY_COST), None for no limit;
+        larger jobs fail with Argon2ParameterError.
+    :param Argon2Pool pool: the pool to use.  Without pool, a pool is kept
+        for all calls with the same workers and max_memory_cost. """
+    global _default_pool
+    if pool is None:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if (_default_pool is None or _default_pool.workers != workers or
+                _default_pool.max_memory_cost != max_memory_cost):
+            if _default_pool is not None:
+                _default_pool.close()
+            _default_pool = Argon2Pool(workers, max_memory_cost)
+        pool = _default_pool
+    return pool.imap(jobs)
+
+# the state of a worker process of an Argon2Pool
+_worker_max_memory_cost = None
+_worker_memory = bytearray()
+
+def _pool_init(max_memory_cost):
+    global _worker_max_memory_cost
+    _worker_max_memory_cost = max_memory_cost
+
+def _pool_hash(job):
+    index, args = job
+    try:
+        if isinstance(args, dict):
+            return index, _worker_argon2(**args)
+        return index, _worker_argon2(*args)
+    except Exception as e:
+        return index, e
+
+def _worker_argon2(password, salt, time_cost, memory_cost, parallelism,
+                   tag_length=32, secret=b'', associated_data=b'',
+                   type_code=ARGON2I, version=ARGON2_DEFAULT_VERSION):
+    """ `argon2' in a worker process, in the matrix of the worker. """
+    global _worker_memory
+    _check_parameters(time_cost, memory_cost, parallelism, type_code, version)
+    if (_worker_max_memory_cost is not None
+            and memory_cost > _worker_max_memory_cost):
+        raise Argon2ParameterError("memory_cost can't be more than %d"
+                                   % _worker_max_memory_cost)
+    m_prime = _m_prime(memory_cost, parallelism)
+    if len(_worker_memory) < m_prime * 1024:
+        _worker_memory = None  # free the old matrix first
+        _worker_memory = _allocate_matrix(m_prime)
+    try:
+        H0 = _H0(password, salt, time_cost, memory_cost, parallelism,
+                 tag_length, secret, associated_data, type_code, version)
+        _fill_matrix(_worker_memory, H0, time_cost, parallelism, m_prime,
+                     type_code, version)
+        return _H_prime(_final_block(_worker_memory, m_prime // parallelism,
+                                     parallelism), tag_length)
+    finally:
+        if len(_worker_memory) > 1024 * (_worker_max_memory_cost
+                                         or POOL_MAX_MEMORY_COST):
+            _worker_memory = bytearray()
+
+# Encoded hashes.
+#
+# hash_encoded returns the hash together with the salt and the parameters,
+# in the PHC string format of the reference implementation:
+#   $argon2id$v=19$m=65536,t=3,p=4$<salt>$<hash>
+# with the salt and the hash in base64 without padding.  verify reads the
+# parameters back from this string, so nothing else has to be stored.
+# needs_rehash tells if a hash was made with weaker parameters than the
+# current policy, so it can be replaced after the next successful login.
+
+ARGON2_TYPE_NAMES = {ARGON2D: 'argon2d', ARGON2I: 'argon2i', ARGON2ID: 'argon2id'}
+
+# the shortest salt and tag of an encoded hash (section 3.1 of RFC 9106)
+ARGON2_MIN_SALT_LENGTH = 8
+ARGON2_MIN_TAG_LENGTH = 4
+
+def hash_encoded(password, time_cost, memory_cost, parallelism, salt=None,
+                 salt_length=16, tag_length=32, secret=b'',
+                 type_code=ARGON2ID, version=ARGON2_DEFAULT_VERSION,
+                 threads=None, use_threads=False):
+    """ Compute the Argon2 hash for *password*, encoded as a string with
+    the parameters and the salt.  Without salt, a random salt of
+    *salt_length* bytes is used.  See `argon2' for the other arguments.
+
+    :rtype: str """
+    if salt is None:
+        salt = os.urandom(salt_length)
+    if len(salt) < ARGON2_MIN_SALT_LENGTH or tag_length < ARGON2_MIN_TAG_LENGTH:
+        raise Argon2ParameterError("the salt should be at least %d bytes and"
+                                   " the tag at least %d bytes"
+                                   % (ARGON2_MIN_SALT_LENGTH,
+                                      ARGON2_MIN_TAG_LENGTH))
+    tag = argon2(password, salt, time_cost, memory_cost, parallelism,
+                 tag_length, secret, b'', type_code, threads, version,
+                 use_threads)
+    return '$%s$v=%d$m=%d,t=%d,p=%d$%s$%s' % (
+                ARGON2_TYPE_NAMES[type_code], version, memory_cost,
+                time_cost, parallelism, _b64encode(salt), _b64encode(tag))
+
+def decode_hash(encoded):
+    """ The parameters, the salt and the tag of an encoded hash, as a dict
+    with the keys type_code, version, memory_cost, time_cost, parallelism,
+    salt and tag.  Raises Argon2Error if *encoded* is not a valid hash. """
+    parts = encoded.split('$')
+    if len(parts) == 5:
+        # without version: version 1.0
+        parts.insert(2, 'v=%d' % 0x10)
+    try:
+        empty, name, version, parameters, salt, tag = parts
+        type_code = {n: t for t, n in ARGON2_TYPE_NAMES.items()}[name]
+        if empty or not version.startswith('v='):
+            raise ValueError
+        values = dict(parameter.split('=') for parameter in parameters.split(','))
+        if sorted(values) != ['m', 'p', 't']:
+            raise ValueError
+        decoded = dict(type_code=type_code,
+                       version=int(version[2:]),
+                       memory_cost=int(values['m']),
+                       time_cost=int(values['t']),
+                       parallelism=int(values['p']),
+                       salt=_b64decode(salt),
+                       tag=_b64decode(tag))
+    except (ValueError, KeyError, binascii.Error):
+        raise Argon2Error("invalid encoded argon2 hash")
+    if (len(decoded['salt']) < ARGON2_MIN_SALT_LENGTH
+            or len(decoded['tag']) < ARGON2_MIN_TAG_LENGTH):
+        raise Argon2Error("the salt or the tag of the encoded argon2 hash"
+                          " is too short")
+    _check_parameters(decoded['time_cost'], decoded['memory_cost'],
+                      decoded['parallelism'], type_code, decoded['version'])
+    return decoded
+
+def verify(encoded, password, secret=b'', threads=None, use_threads=False):
+    """ True if *encoded* (see `hash_encoded') is the hash of *password*.
+    The tags are compared in constant time.  Raises Argon2Error if
+    *encoded* is not a valid hash. """
+    decoded = decode_hash(encoded)
+    tag = decoded['tag']
+    computed = argon2(password, decoded['salt'], decoded['time_cost'],
+                      decoded['memory_cost'], decoded['parallelism'],
+                      len(tag), secret, b'', decoded['type_code'],
+                      threads, decoded['version'], use_threads)
+    return hmac.compare_digest(computed, tag)
+
+def needs_rehash(encoded, policy):
+    """ True if *encoded* was made with other parameters than *policy*
+    asks for: another type or version, or a lower time_cost, memory_cost,
+    parallelism, tag_length or salt_length.  *policy* is a dict with (some
+    of) these keys, the keys that are missing are not checked. """
+    decoded = decode_hash(encoded)
+    current = dict(decoded, tag_length=len(decoded['tag']),
+                   salt_length=len(decoded['salt']))
+    for key in ('type_code', 'version'):
+        if key in policy and current[key] != policy[key]:
+            return True
+    return any(key in policy and current[key] < policy[key]
+               for key in ('time_cost', 'memory_cost', 'parallelism',
+                           'tag_length', 'salt_length'))
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4), validate=True)
+
+# Calibration.
+#
+# calibrate finds the strongest parameters for this machine that hash a
+# password within target_ms milliseconds.  Memory is the main cost of
+# Argon2, so it first takes as much memory as allowed (or as fits in the
+# target) with one pass, and then as many passes as fit in the target.
+# Both are found with a bounded search on real measurements: the value is
+# doubled until a hash takes more than target_ms, and then the interval is
+# narrowed until the best value that fits is within the tolerance of the
+# target.  A hash has a fixed cost that doesn't depend on the parameters
+# (H0, the final block and, with threads, starting the workers): it is
+# measured first and left out when the next value is estimated from a
+# measurement.  The report is a dict that can be saved with json.dump.
+
+CALIBRATE_TOLERANCE = 0.1
+CALIBRATE_MAX_PROBES = 32  # per search
 
-    return _H_prime(B_final, tag_length)
+def calibrate(target_ms, max_memory_kib, cores=None, type_code=ARGON2ID,
+              version=ARGON2_DEFAULT_VERSION, use_threads=False,
+              tolerance=CALIBRATE_TOLERANCE):
+    """ The strongest parameters that hash within *target_ms* milliseconds
+    on this machine, with at most *max_memory_kib* kibibytes and *cores*
+    lanes and threads (default: the number of CPUs).
 
-def _fill_segment(B, t, segment, i, type_code, segment_length, H0,
-                        q, parallelism, m_prime, time_cost, version):
-    # Argon2i computes a bunch of pseudo-random numbers
-    # for every segment.
+    The measured time of the result is between (1 - *tolerance*) *
+    target_ms and target_ms, unless the steps are too coarse for that:
+    4 * cores kibibytes of memory, or one more pass with all of
+    *max_memory_kib*.
+
+    Returns a report: a dict with the parameters (time_cost, memory_cost,
+    parallelism, type_code and version, as in the policy of
+    `needs_rehash'), the measured time, the fixed cost of a hash and all
+    measurements. """
+    if cores is None:
+        cores = os.cpu_count() or 1
+    parallelism = cores
+    if max_memory_kib < 8 * parallelism:
+        raise Argon2ParameterError("max_memory_kib can't be less than 8"
+                                   " times the number of cores")
+    probes = []
+
+    def measure(time_cost, memory_cost):
+        # the fastest of two hashes: a slow one was interrupted
+        times = []
+        for _ in range(2):
+            start = time.perf_counter()
+            argon2(b'calibration password', b'calibration salt', time_cost,
+                   memory_cost, parallelism, type_code=type_code,
+                   threads=cores, version=version, use_threads=use_threads)
+            times.append((time.perf_counter() - start) * 1000)
+        ms = min(times)
+        probes.append(dict(time_cost=time_cost, memory_cost=memory_cost, ms=ms))
+        return ms
+
+    def round_memory(memory_cost):
+        return max(8 * parallelism, _m_prime(int(memory_cost), parallelism))
+
+    # the fixed cost: the smallest hash
+    smallest = 8 * parallelism
+    overhead = measure(1, smallest)
+    if overhead > target_ms:
+        raise Argon2ParameterError("even the smallest parameters take"
+                                   " more than %s ms" % target_ms)
+
+    def search(measure_at, value, ms, limit, step):
+        # the largest value (up to limit, if any) that hashes within
+        # target_ms, starting from value that takes ms; also if the target
+        # was passed (if not, the limit was reached)
+        low, high = (value, ms), None
+        retried = False
+        for _ in range(CALIBRATE_MAX_PROBES):
+            if high is None:
+                if limit is not None and low[0] >= limit:
+                    break
+                value = 2 * low[0] if limit is None else min(limit, step(2 * low[0]))
+            elif low[1] >= (1 - tolerance) * target_ms:
+                break
+            else:
+                # without the fixed cost, the time is proportional to the value
+                value = step(low[0] * (target_ms - overhead)
+                             / max(low[1] - overhead, 1e-9))
+                if not low[0] < value < high:
+                    value = step((low[0] + high) / 2)
+                if not low[0] < value < high:
+                    if retried:
+                        break
+                    # nothing in between: measure high again, the machine
+                    # may have been busy
+                    value, high, retried = high, None, True
+            ms = measure_at(value)
+            if ms <= target_ms:
+                low = (value, ms)
+            else:
+                high = value
+        return low[0], low[1], high is not None
+
+    memory_cost, ms, passed = search(lambda memory_cost: measure(1, memory_cost),
+                                     smallest, overhead,
+                                     round_memory(max_memory_kib), round_memory)
+    time_cost = 1
+    if not passed:
+        # all the memory fits in one pass: more passes
+        time_cost, ms, _ = search(
+                    lambda time_cost: measure(time_cost, memory_cost),
+                    1, ms, None, int)
+
+    return dict(time_cost=time_cost,
+                memory_cost=memory_cost,
+                parallelism=parallelism,
+                type_code=type_code,
+                version=version,
+                ms=ms,
+                target_ms=target_ms,
+                tolerance=tolerance,
+                overhead_ms=overhead,
+                max_memory_kib=max_memory_kib,
+                cores=cores,
+                compression_backend=compression_backend,
+                blake2b_backend=blake2b_backend,
+                python=platform.python_version(),
+                machine=platform.machine(),
+                probes=probes)
+
+# Hashing from asyncio.
+#
+# argon2_async and verify_async run the hash in an Argon2Executor, so the
+# event loop keeps running while a password is hashed.  The executor has a
+# fixed number of worker processes (the concurrency limit) and a bounded
+# queue: when max_workers jobs are running and max_queue jobs are waiting,
+# the next job is refused with Argon2QueueFull instead of being queued, so a
+# storm of logins can't make the memory use grow without bounds.  The counters
+# of the executor (see stats()) show the load.
+
+class Argon2QueueFull(Argon2Error):
+    """ The queue of an Argon2Executor is full. """
+    pass
+
+class Argon2Executor(object):
+    """ A bounded pool of worker processes for `argon2_async'. """
+
+    def __init__(self, max_workers=None, max_queue=None, max_memory_cost=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_workers <= 0:
+            raise Argon2ParameterError("max_workers must be strictly positive")
+        if max_queue is None:
+            max_queue = 4 * max_workers
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+                                max_workers, initializer=_pool_init,
+                                initargs=(max_memory_cost,))
+        self._lock = threading.Lock()
+        self.pending = 0     # running and waiting jobs
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0   # cancelled before a worker started them
+        self.rejected = 0
+
+    @property
+    def queue_depth(self):
+        """ The number of jobs that wait for a worker. """
+        return max(0, self.pending - self.max_workers)
+
+    def stats(self):
+        with self._lock:
+            return dict(max_workers=self.max_workers,
+                        max_queue=self.max_queue,
+                        running=min(self.pending, self.max_workers),
+                        queue_depth=self.queue_depth,
+                        submitted=self.submitted,
+                        completed=self.completed,
+                        failed=self.failed,
+                        cancelled=self.cancelled,
+                        rejected=self.rejected)
+
+    async def hash(self, *args, **kwargs):
+        """ `argon2' in a worker process (without threads and use_threads).
+
+        Raises Argon2QueueFull if the queue is full. """
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise Argon2QueueFull("%d argon2 jobs are waiting"
+                                      % self.queue_depth)
+            self.pending += 1
+            self.submitted += 1
+        try:
+            future = self._executor.submit(_worker_argon2, *args, **kwargs)
+        except BaseException:
+            self._job_done(None)
+            raise
+        # the job keeps its slot until the worker is done with it, also when
+        # the caller stops waiting for it
+        future.add_done_callback(self._job_done)
+        return await asyncio.wrap_future(future)
+
+    def _job_done(self, future):
+        with self._lock:
+            self.pending -= 1
+            if future is not None and future.cancelled():
+                self.cancelled += 1
+            elif future is None or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+_default_executor = None
+_executor_lock = threading.Lock()
+
+def default_executor():
+    """ The Argon2Executor of argon2_async and verify_async without executor,
+    created on first use. """
+    global _default_executor
+    with _executor_lock:
+        if _default_executor is None:
+            _default_executor = Argon2Executor()
+        return _default_executor
+
+async def argon2_async(password, salt, time_cost, memory_cost, parallelism,
+                       tag_length=32, secret=b'', associated_data=b'',
+                       type_code=ARGON2I, version=ARGON2_DEFAULT_VERSION,
+                       executor=None):
+    """ `argon2' for asyncio: the hash is computed by *executor*
+    (default: `default_executor()'). """
+    if executor is None:
+        executor = default_executor()
+    return await executor.hash(password, salt, time_cost, memory_cost,
+                               parallelism, tag_length, secret,
+                               associated_data, type_code, version)
+
+async def verify_async(tag, password, salt, time_cost, memory_cost,
+                       parallelism, secret=b'', associated_data=b'',
+                       type_code=ARGON2I, version=ARGON2_DEFAULT_VERSION,
+                       executor=None):
+    """ True if *tag* is the Argon2 hash of *password*, compared in
+    constant time.  See `argon2_async'. """
+    computed = await argon2_async(password, salt, time_cost, memory_cost,
+                                  parallelism, len(tag), secret,
+                                  associated_data, type_code, version,
+                                  executor)
+    return hmac.compare_digest(computed, tag)
+
+def _fill_segment_into(memory, t, segment, i, type_code, segment_length, H0,
+                       q, parallelism, m_prime, time_cost, version):
+    """ Fills segment *segment* of lane *i* in pass *t*. """
     data_independant = ((type_code == ARGON2I)
             or (type_code == ARGON2ID and t == 0 and segment <= 1))
     if data_independant:
-        # See `generate_addresses' in reference implementation
-        # and section 3.3 of the specification.
-        pseudo_rands = []
-        ctr = 0  # `i' in the specification
-        while len(pseudo_rands) < segment_length:
-            ctr += 1
-            address_block = _compress(b'\0'*1024, _compress(b'\0'*1024,
-                                struct.pack('<QQQQQQQ', t, i, segment, m_prime,
-                                                    time_cost, type_code, ctr)
-                                    + b'\0'*968))
-            for addr_i in range(0, 1024, 8):
-                pseudo_rands.append(struct.unpack('<II',
-                            address_block[addr_i:addr_i+8]))
+        stream = _cached_address_stream if cache_addresses else address_stream
+        J1s, J2s = stream(t, i, segment, m_prime, time_cost, type_code,
+                          segment_length, parallelism)
+    xor = t != 0 and version == 0x13
+    lane = i * q
+    compress = _compressor(memory)
 
     for index in range(segment_length):
         j = segment * segment_length + index
+        offset = (lane + j) * 1024
         if t == 0 and j < 2:
             # First two columns are special.
-            B[i][j] = _H_prime(H0 + struct.pack('<II', j, i), 1024)
+            memory[offset:offset + 1024] = _H_prime(
+                                    H0 + struct.pack('<II', j, i), 1024)
             continue
 
-        # See `section 3.3. Indexing' of argon2 spec.
-        # First, we derive two pseudo-random values from the current
-        # state.  This is where Argon2i and Argon2d differ.
+        previous = lane + (j - 1) % q
         if data_independant:
-            J1, J2 = pseudo_rands[index]
+            J1, J2 = J1s[index], J2s[index]
         else:
-            J1, J2 = struct.unpack_from('<II', B[i][(j-1)%q][:8])
+            J1, J2 = struct.unpack_from('<II', memory, previous * 1024)
 
-        # Using the pseudo-random J1 and J2, we pick a reference
-        # block to mix with the previous one to create the next.
-        i_prime = i if t == 0 and segment == 0 else J2 % parallelism
+        i_prime, j_prime = _reference(J1, J2, t, segment, index, i,
+                                      segment_length, q, parallelism)
+        compress(lane + j, previous, i_prime * q + j_prime, xor)
 
-        if t == 0:
-            if segment == 0 or i == i_prime:
-                ref_area_size = j - 1
-            elif index == 0:
-                ref_area_size = segment * segment_length - 1
-            else:
-                ref_area_size = segment * segment_length
-        elif i == i_prime:  # same_lane
-            ref_area_size = q - segment_length + index - 1
-        elif index == 0:
-            ref_area_size = q - segment_length - 1
-        else:
-            ref_area_size = q - segment_length
-
-        rel_pos = (J1 ** 2) >> 32
-        rel_pos = ref_area_size - 1 - ((ref_area_size * rel_pos) >> 32)
-        start_pos = 0
-
-        if t != 0 and segment != 3:
-            start_pos = (segment + 1) * segment_length
-        j_prime = (start_pos + rel_pos) % q
-
-        # Mix the previous and reference block to create
-        # the next block.
-        new_block = _compress(B[i][(j-1)%q], B[i_prime][j_prime])
-        if t != 0 and version == 0x13:
-            new_block = xor1024(B[i][j], new_block)
-        B[i][j] = new_block
-
-    # If we are run in a separate thread, then B is a copy.  Return changes.
-    return B[i][segment*segment_length:(segment+1)*segment_length]
-
-
-# xor1024: XOR two 1024 byte blocks with eachother.
-
-if True:
-    def xor1024(a, b):
-        return (int.from_bytes(a, byteorder='little') ^
-                int.from_bytes(b, byteorder='little')).to_bytes(
-                                 1024, byteorder='little')
-else:
-    _1024B_STRUCT = struct.Struct('Q'*128)
-    def xor1024(a, b):
-        a2 = _1024B_STRUCT.unpack(a)
-        b2 = list(_1024B_STRUCT.unpack(b))
-        for i in xrange(128):
-            b2[i] ^= a2[i]
-        return _1024B_STRUCT.pack(*b2)
-
-def _compress(X, Y):
-    """ Argon2's compression function G.
-
-    This function is based on Blake2's compression function.
-    For the definition, see section 3.4 of Argon2's specification. """
-    R = xor1024(X, Y)
-    Q = []
-    Z = [None]*64
-    for i in range(0, 64, 8):
-        Q.extend(_P(R[i    *16:(i+1)*16],
-                    R[(i+1)*16:(i+2)*16],
-                    R[(i+2)*16:(i+3)*16],
-                    R[(i+3)*16:(i+4)*16],
-                    R[(i+4)*16:(i+5)*16],
-                    R[(i+5)*16:(i+6)*16],
-                    R[(i+6)*16:(i+7)*16],
-                    R[(i+7)*16:(i+8)*16]))
-    for i in range(8):
-        out = _P(Q[i], Q[i+8], Q[i+16], Q[i+24],
-                    Q[i+32], Q[i+40], Q[i+48], Q[i+56])
-        for j in range(8):
-            Z[i + j*8] = out[j]
-    return xor1024(b''.join(Z), R)
-
-
-def _P(S0, S1, S2, S3, S4, S5, S6, S7):
-    """ Permutation used in Argon2's compression function G.
-
-    It is a modification of the permutation used in Blake2.
-    See Appendix A of the specification of Argon2. """
-    S = (S0, S1, S2, S3, S4, S5, S6, S7)
-    v = [None] * 16
-    for i in range(8):
-        tmp1, tmp2 = struct.unpack_from('<QQ', S[i])
-        v[2*i] = tmp1
-        v[2*i+1] = tmp2
-    _G(v, 0, 4, 8, 12)
-    _G(v, 1, 5, 9, 13)
-    _G(v, 2, 6, 10, 14)
-    _G(v, 3, 7, 11, 15)
-    _G(v, 0, 5, 10, 15)
-    _G(v, 1, 6, 11, 12)
-    _G(v, 2, 7, 8, 13)
-    _G(v, 3, 4, 9, 14)
-    ret =  [struct.pack("<QQ", v[2*i], v[2*i+1]) for i in range(8)]
-    return ret
+# The addresses of the data-independent segments (Argon2i, and the first half
+# pass of Argon2id) only depend on public parameters, not on the password.
+# address_stream computes all of them for a segment at once (with numpy, all
+# address blocks of the segment are compressed together).  The segments are
+# cached per parameter set (m', time_cost, type and parallelism), so hashing
+# many passwords with the same parameters computes them only once.  The least
+# recently used parameter sets are dropped when the cache holds more than
+# address_cache_bytes of addresses.  Set cache_addresses to False to always
+# compute them.
+cache_addresses = True
+address_cache_bytes = 64 << 20
+
+_address_cache = {}         # parameter set -> {(t, lane, segment): (J1s, J2s)}
+_address_cache_lock = threading.Lock()
+_address_cache_stats = dict(hits=0, misses=0, bytes=0)
+
+def address_stream(t, i, segment, m_prime, time_cost, type_code,
+                   segment_length, parallelism=None):
+    """ The pseudo-random J1 and J2 of a data-independent segment, as two
+    read-only memoryviews of segment_length unsigned 32-bit integers.
+    *parallelism* is not used, it is part of the key of the cache.
+
+    See `generate_addresses' in reference implementation
+    and section 3.3 of the specification. """
+    nbr_blocks = -(-segment_length // 128)
+    if compression_backend == "numpy":
+        # G(0, G(0, input)): with X = 0, R is the input block itself.
+        inputs = numpy.zeros((nbr_blocks, 128), dtype=numpy.uint64)
+        inputs[:, :6] = (t, i, segment, m_prime, time_cost, type_code)
+        inputs[:, 6] = numpy.arange(1, nbr_blocks + 1)  # `i' in the specification
+        words = _numpy_compress(_numpy_compress(inputs)).reshape(-1)[:segment_length]
+        return (_read_only((words & _M32).astype(numpy.uint32).tobytes()),
+                _read_only((words >> numpy.uint64(32)).astype(numpy.uint32).tobytes()))
+    J1s, J2s = array.array('I'), array.array('I')
+    for ctr in range(1, nbr_blocks + 1):  # `i' in the specification
+        address_block = _compress_words(_compress_words(
+                            [t, i, segment, m_prime, time_cost, type_code, ctr]
+                            + [0] * 121))
+        J1s.extend(word & 0xffffffff for word in address_block)
+        J2s.extend(word >> 32 for word in address_block)
+    del J1s[segment_length:], J2s[segment_length:]
+    return _read_only(J1s.tobytes()), _read_only(J2s.tobytes())
 
+def _read_only(data):
+    # native 32-bit integers over immutable bytes
+    return memoryview(data).cast('I')
+
+def _cached_address_stream(t, i, segment, m_prime, time_cost, type_code,
+                           segment_length, parallelism):
+    """ `address_stream' from the cache of its parameter set. """
+    key = (m_prime, time_cost, type_code, parallelism)
+    with _address_cache_lock:
+        segments = _address_cache.pop(key, {})
+        _address_cache[key] = segments        # the most recently used one
+        streams = segments.get((t, i, segment))
+        _address_cache_stats['hits' if streams else 'misses'] += 1
+    if streams:
+        return streams
+    streams = address_stream(t, i, segment, m_prime, time_cost, type_code,
+                             segment_length)
+    with _address_cache_lock:
+        segments = _address_cache.setdefault(key, {})
+        if segments.setdefault((t, i, segment), streams) is streams:
+            _address_cache_stats['bytes'] += 8 * segment_length
+        while _address_cache_stats['bytes'] > address_cache_bytes:
+            oldest = next(iter(_address_cache))
+            _address_cache_stats['bytes'] -= sum(
+                    J1s.nbytes + J2s.nbytes
+                    for J1s, J2s in _address_cache.pop(oldest).values())
+    return streams
+
+def address_cache_info():
+    """ Hits, misses, parameter sets and bytes of the address cache. """
+    with _address_cache_lock:
+        return dict(_address_cache_stats, parameter_sets=len(_address_cache))
+
+def address_cache_clear():
+    """ Empties the address cache. """
+    with _address_cache_lock:
+        _address_cache.clear()
+        _address_cache_stats.update(hits=0, misses=0, bytes=0)
+
+def _compress_into(memory, dest, x, y, xor=False):
+    """ Argon2's compression function G on blocks in one buffer.
+
+    The blocks with numbers *x* and *y* are compressed into block *dest*.
+    With *xor* (version 1.3, after the first pass), the result is XORed
+    with the block that was at *dest*. """
+    unpack = _BLOCK_WORDS.unpack_from
+    R = [a ^ b for a, b in zip(unpack(memory, x * 1024),
+                               unpack(memory, y * 1024))]
+    Z = _compress_words(R)
+    if xor:
+        Z = [a ^ b for a, b in zip(Z, unpack(memory, dest * 1024))]
+    _BLOCK_WORDS.pack_into(memory, dest * 1024, *Z)
+
+def _compress_words(R):
+    """ P applied to the rows and the columns of R, XORed with R.
+
+    R is a block as a list of 128 64-bit words.  Row i of the 8x8 matrix
+    of 16 byte registers is words 16*i to 16*i+15, column i is the
+    registers i, i+8, ..., i+56.  `_G_ROUNDS' has the word indices of
+    all the quarter-rounds. """
+    v = list(R)
+    for a, b, c, d in _G_ROUNDS:
+        _G(v, a, b, c, d)
+    return [a ^ b for a, b in zip(v, R)]
+
+def _p_rounds(words):
+    # the quarter-rounds of the permutation P, on the 16 words `words' of the block
+    return [(words[a], words[b], words[c], words[d])
+            for a, b, c, d in ((0, 4, 8, 12), (1, 5, 9, 13),
+                               (2, 6, 10, 14), (3, 7, 11, 15),
+                               (0, 5, 10, 15), (1, 6, 11, 12),
+                               (2, 7, 8, 13), (3, 4, 9, 14))]
+
+_G_ROUNDS = tuple(
+    [g for i in range(8) for g in _p_rounds([16*i + k for k in range(16)])] +
+    [g for i in range(8)
+       for g in _p_rounds([2*i + 16*(k // 2) + k % 2 for k in range(16)])])
+
+
+# The compression backend.
+#
+# With numpy, a block is a (128,) array of uint64 and the compression function
+# works on whole arrays: the 8 row-wise applications of P are done at once on
+# an (8, 16) view of the block, and the 8 column-wise applications at once on
+# the (8, 16) array of the columns.  Within P, the 4 quarter-rounds on the
+# columns of the 4x4 matrix of words are done at once, and so are the 4 on
+# the diagonals.  uint64 arithmetic wraps around, which is exactly the
+# arithmetic modulo 2**64 of `_G'.  The result is the same as `_compress_words'.
+#
+# Set compression_backend to "python" to disable the numpy backend,
+# or use set_compression_backend.
+compression_backend = "numpy" if numpy is not None else "python"
+
+def set_compression_backend(backend):
+    """ Selects the compression function: "numpy" or "python". """
+    global compression_backend
+    if backend not in ("numpy", "python"):
+        raise ValueError("unknown compression backend: %s" % backend)
+    if backend == "numpy" and numpy is None:
+        raise ValueError("the numpy compression backend requires numpy")
+    compression_backend = backend
+
+def _compressor(memory):
+    """ compress(dest, x, y, xor): `_compress_into' on *memory*,
+    with the selected backend. """
+    if compression_backend == "numpy":
+        words = numpy.frombuffer(memory, dtype='<u8').reshape(-1, 128)
+        return functools.partial(_numpy_compress_into, words)
+    return functools.partial(_compress_into, memory)
+
+if numpy is not None:
+    _M32 = numpy.uint64(0xffffffff)
+    _TWO = numpy.uint64(2)
+    _SHIFTS = {n: (numpy.uint64(n), numpy.uint64(64 - n)) for n in (32, 24, 16, 63)}
+    # the words of column i of the 8x8 matrix of registers, as in `_G_ROUNDS'
+    _COLUMNS = numpy.array([[2*i + 16*(k // 2) + k % 2 for k in range(16)]
+                            for i in range(8)])
+    # the diagonals of the 4x4 matrix of words, and back
+    _DIAGONAL = (numpy.array([1, 2, 3, 0]), numpy.array([2, 3, 0, 1]),
+                 numpy.array([3, 0, 1, 2]))
+    _UNDIAGONAL = (_DIAGONAL[2], _DIAGONAL[1], _DIAGONAL[0])
+
+def _numpy_rotr(x, n):
+    right, left = _SHIFTS[n]
+    return (x >> right) | (x << left)
+
+def _numpy_G(a, b, c, d):
+    """ `_G' on arrays of words. """
+    a = a + b + _TWO * (a & _M32) * (b & _M32)
+    d = _numpy_rotr(d ^ a, 32)
+    c = c + d + _TWO * (c & _M32) * (d & _M32)
+    b = _numpy_rotr(b ^ c, 24)
+    a = a + b + _TWO * (a & _M32) * (b & _M32)
+    d = _numpy_rotr(d ^ a, 16)
+    c = c + d + _TWO * (c & _M32) * (d & _M32)
+    b = _numpy_rotr(b ^ c, 63)
+    return a, b, c, d
+
+def _numpy_P(v):
+    """ The permutation P (Appendix A of the specification) on every row of
+    the (..., 16) array of words *v*. """
+    a, b, c, d = _numpy_G(v[..., 0:4], v[..., 4:8], v[..., 8:12], v[..., 12:16])
+    a, b, c, d = _numpy_G(a, b[..., _DIAGONAL[0]], c[..., _DIAGONAL[1]],
+                          d[..., _DIAGONAL[2]])
+    return numpy.concatenate((a, b[..., _UNDIAGONAL[0]], c[..., _UNDIAGONAL[1]],
+                              d[..., _UNDIAGONAL[2]]), axis=-1)
+
+def _numpy_compress(R):
+    """ `_compress_words' on the (..., 128) uint64 array *R*. """
+    Q = _numpy_P(R.reshape(R.shape[:-1] + (8, 16))).reshape(R.shape)
+    Z = numpy.empty_like(R)
+    Z[..., _COLUMNS] = _numpy_P(Q[..., _COLUMNS])
+    return Z ^ R
+
+def _numpy_compress_into(words, dest, x, y, xor=False):
+    """ `_compress_into' on the (m_prime, 128) array *words*. """
+    Z = _numpy_compress(words[x] ^ words[y])
+    if xor:
+        words[dest] ^= Z
+    else:
+        words[dest] = Z
 
 def _G(v, a, b, c, d):
     """ Quarter-round of the permutation used in the compression of Argon2.
@@ -347,7 +1102,7 @@ def _H_prime(X, tag_length):
     buf.write(Blake2b(V, digest_length=todo).digest())  # V_{r+1}
     return buf.getvalue()
 
-class Blake2b(object):
+class PureBlake2b(object):
     """ Minimal implementation of Blake2b, as required by Argon2. """
     
     IV = [0x6a09e667f3bcc908, 0xbb67ae8584caa73b,
@@ -438,29 +1193,207 @@ class Blake2b(object):
         v[14] ^= self._f[0]
         v[15] ^= self._f[1]
         for r in range(12):
-            Blake2b._G(v, m, r, 0, 0, 4, 8, 12)
-            Blake2b._G(v, m, r, 1, 1, 5, 9, 13)
-            Blake2b._G(v, m, r, 2, 2, 6, 10, 14)
-            Blake2b._G(v, m, r, 3, 3, 7, 11, 15)
-            Blake2b._G(v, m, r, 4, 0, 5, 10, 15)
-            Blake2b._G(v, m, r, 5, 1, 6, 11, 12)
-            Blake2b._G(v, m, r, 6, 2, 7, 8, 13)
-            Blake2b._G(v, m, r, 7, 3, 4, 9, 14)
+            PureBlake2b._G(v, m, r, 0, 0, 4, 8, 12)
+            PureBlake2b._G(v, m, r, 1, 1, 5, 9, 13)
+            PureBlake2b._G(v, m, r, 2, 2, 6, 10, 14)
+            PureBlake2b._G(v, m, r, 3, 3, 7, 11, 15)
+            PureBlake2b._G(v, m, r, 4, 0, 5, 10, 15)
+            PureBlake2b._G(v, m, r, 5, 1, 6, 11, 12)
+            PureBlake2b._G(v, m, r, 6, 2, 7, 8, 13)
+            PureBlake2b._G(v, m, r, 7, 3, 4, 9, 14)
         self._h = [self._h[i] ^ v[i] ^ v[i+8] for i in range(8)]
 
     @staticmethod
     def _G(v, m, r, i, a, b, c, d):
         va, vb, vc, vd = v[a], v[b], v[c], v[d]
-        va = (va + vb + m[Blake2b.SIGMA[r][2*i]]) & 0xffffffffffffffff
+        va = (va + vb + m[PureBlake2b.SIGMA[r][2*i]]) & 0xffffffffffffffff
         tmp = vd ^ va
         vd = (tmp >> 32) | ((tmp & 0xffffffff) << 32)
         vc = (vc + vd) & 0xffffffffffffffff
         tmp = vb ^ vc
         vb = (tmp >> 24) | ((tmp & 0xffffff) << 40)
-        va = (va + vb + m[Blake2b.SIGMA[r][2*i+1]]) & 0xffffffffffffffff
+        va = (va + vb + m[PureBlake2b.SIGMA[r][2*i+1]]) & 0xffffffffffffffff
         tmp = vd ^ va
         vd = (tmp >> 16) | ((tmp & 0xffff) << 48)
         vc = (vc + vd) & 0xffffffffffffffff
         tmp = vb ^ vc
         vb = (tmp >> 63) | ((tmp << 1) & 0xffffffffffffffff)
         v[a], v[b], v[c], v[d] = va, vb, vc, vd
+
+class HashlibBlake2b(object):
+    """ Blake2b of hashlib, with the interface of `PureBlake2b'. """
+
+    def __init__(self, data=b'', key=b'', digest_length=64):
+        self._h = hashlib.blake2b(data, digest_size=digest_length, key=key)
+        self.finalized = False
+
+    def update(self, data):
+        assert not self.finalized
+        self._h.update(data)
+
+    def final(self):
+        if not self.finalized:
+            self._digest = self._h.digest()
+            self.finalized = True
+        return self._digest
+    digest = final
+
+    def hexdigest(self):
+        return binascii.hexlify(self.final())
+
+# The Blake2b backend.
+#
+# Blake2b computes H0 and, through H', the first two blocks of every lane and
+# the tag.  The C implementation in hashlib gives the same output as
+# `PureBlake2b', which is used when hashlib has no blake2b.  The rest of this
+# module uses the name Blake2b, which is the class of the selected backend.
+# Use set_blake2b_backend to select a backend: "hashlib" or "python".
+
+def set_blake2b_backend(backend):
+    """ Selects the Blake2b implementation: "hashlib" or "python". """
+    global Blake2b, blake2b_backend
+    if backend == "hashlib":
+        if not hasattr(hashlib, 'blake2b'):
+            raise ValueError("this hashlib has no blake2b")
+        Blake2b = HashlibBlake2b
+    elif backend == "python":
+        Blake2b = PureBlake2b
+    else:
+        raise ValueError("unknown blake2b backend: %s" % backend)
+    blake2b_backend = backend
+
+set_blake2b_backend("hashlib" if hasattr(hashlib, 'blake2b') else "python")
+
+if __name__ == "__main__":
+    import signal
+
+    # the matrix is one zeroed buffer, an anonymous mmap from MMAP_THRESHOLD bytes on
+    assert _allocate_matrix(32) == bytearray(32 * 1024)
+    assert isinstance(_allocate_matrix(MMAP_THRESHOLD // 1024), mmap.mmap)
+
+    # The test vectors of RFC 9106, for all backends, with and without workers
+    vectors = {ARGON2D: '512b391b6f1162975371d30919734294f868e3be3984f3c1a13a4db9fabe4acb',
+               ARGON2I: 'c814d9d1dc7f37aa13f0d77f2494bda1c8de6b016dd388d29952a4c4672b6ce8',
+               ARGON2ID: '0d640df58d78766c08c037a34a8b53c9d01ef0452d75b65eb52520e96b01e659'}
+    default_backends = (compression_backend, blake2b_backend)
+    for compression in ("python", "numpy") if numpy is not None else ("python",):
+        set_compression_backend(compression)
+        for blake2b in ("python", "hashlib") if hasattr(hashlib, 'blake2b') else ("python",):
+            set_blake2b_backend(blake2b)
+            for type_code, tag in vectors.items():
+                for threads, use_threads in ((1, False), (4, False), (4, True)):
+                    assert argon2(b'\1' * 32, b'\2' * 16, 3, 32, 4, 32, b'\3' * 8, b'\4' * 12,
+                                  type_code, threads, use_threads=use_threads).hex() == tag
+    set_compression_backend(default_backends[0])
+    set_blake2b_backend(default_backends[1])
+
+    # a lane worker that is killed makes argon2 fail, instead of hang
+    if hasattr(signal, 'SIGKILL'):
+        failures = []
+        def hash_with_workers():
+            try:
+                argon2(b'pw', b'saltsalt', 3, 8192, 2)
+            except Argon2Error as e:
+                failures.append(e)
+        hashing = threading.Thread(target=hash_with_workers)
+        hashing.start()
+        while not multiprocessing.active_children():
+            time.sleep(0.01)
+        os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+        hashing.join(60)
+        assert not hashing.is_alive() and failures
+
+    # argon2_many gives the same tags as argon2
+    jobs = [(b'password %d' % i, b'somesalt', 1, 64, 2) for i in range(4)]
+    tags = dict(argon2_many(jobs, workers=2))
+    assert [tags[i] for i in range(4)] == [argon2(*job, threads=1) for job in jobs]
+    # a job that fails doesn't stop the others
+    jobs.insert(1, (b'password', b'somesalt', 1, 2 * POOL_MAX_MEMORY_COST, 1))
+    tags = dict(argon2_many(jobs, workers=2))
+    assert isinstance(tags[1], Argon2ParameterError) and len(tags) == 5
+    assert tags[4] == argon2(*jobs[4], threads=1)
+
+    # a job keeps its slot until it is done, also when its caller gives up;
+    # a job that is cancelled before it runs is not a failure
+    async def cancel_jobs(executor):
+        running = asyncio.ensure_future(executor.hash(b'pw', b'saltsalt', 2, 2048, 1))
+        waiting = [asyncio.ensure_future(executor.hash(b'pw', b'saltsalt', 1, 8, 1))
+                   for _ in range(2)]
+        await asyncio.sleep(0.1)
+        running.cancel()
+        waiting[-1].cancel()
+        await asyncio.sleep(0.1)
+        assert executor.stats()['running'] == 1
+        await asyncio.gather(running, *waiting, return_exceptions=True)
+        while executor.stats()['running']:
+            await asyncio.sleep(0.05)
+    executor = Argon2Executor(max_workers=1, max_queue=2)
+    asyncio.run(cancel_jobs(executor))
+    executor.shutdown()
+    stats = executor.stats()
+    assert stats['cancelled'] == 1 and stats['failed'] == 0
+    assert stats['completed'] == 2 and stats['submitted'] == 3
+
+    # a full queue refuses the next job instead of queueing it
+    async def fill_queue(executor):
+        running = asyncio.ensure_future(executor.hash(b'pw', b'saltsalt', 1, 8, 1))
+        await asyncio.sleep(0)
+        try:
+            await executor.hash(b'pw', b'saltsalt', 1, 8, 1)
+            assert False
+        except Argon2QueueFull:
+            pass
+        return await running
+    executor = Argon2Executor(max_workers=1, max_queue=0)
+    assert asyncio.run(fill_queue(executor)) == argon2(b'pw', b'saltsalt', 1, 8, 1)
+    executor.shutdown()
+    stats = executor.stats()
+    assert stats['rejected'] == 1 and stats['completed'] == 1
+
+    # encoded hashes
+    encoded = hash_encoded(b'password', 2, 64, 1, salt=b'somesalt')
+    assert encoded == '$argon2id$v=19$m=64,t=2,p=1$c29tZXNhbHQ$FqGkmHNGCd0BRW2kBt6fPZ2pPmyGwwChL8FGUhTOSSI'
+    assert verify(encoded, b'password')
+    assert not verify(encoded, b'Password')
+    assert needs_rehash(encoded, dict(memory_cost=128))
+    assert not needs_rehash(encoded, dict(memory_cost=64, time_cost=2, type_code=ARGON2ID))
+    # an empty or short salt or tag is not a valid hash
+    for invalid in ('$argon2id$v=19$m=64,t=2,p=1$$FqGkmHNGCd0BRW2kBt6fPZ2pPmyGwwChL8FGUhTOSSI',
+                    '$argon2id$v=19$m=64,t=2,p=1$c29tZXM$FqGkmHNGCd0BRW2kBt6fPZ2pPmyGwwChL8FGUhTOSSI',
+                    '$argon2id$v=19$m=64,t=2,p=1$c29tZXNhbHQ$',
+                    '$argon2id$v=19$m=64,t=2,p=1$c29tZXNhbHQ$FqGk',
+                    '$argon2id$v=19$m=64,t=2,p=1$c29tZXNhbHQ$Fg'):
+        for check in (decode_hash, lambda encoded: verify(encoded, b'password')):
+            try:
+                check(invalid)
+                assert False
+            except Argon2Error:
+                pass
+
+    # calibrate: the parameters respect the memory limit and the measured time the target,
+    # within the tolerance unless all the memory fits and one more pass doesn't
+    report = calibrate(200, 1024, 1)
+    assert report['memory_cost'] <= 1024 and report['time_cost'] >= 1
+    assert report['parallelism'] == 1 and report['ms'] <= 200
+    assert (report['ms'] >= (1 - report['tolerance']) * 200
+            or report['memory_cost'] == 1024 and report['ms'] * (report['time_cost'] + 1)
+                                                  / report['time_cost'] > 200)
+    assert len(report['probes']) <= 1 + 2 * CALIBRATE_MAX_PROBES
+
+    # the address stream is read-only and the same for both compression backends
+    addresses = address_stream(1, 2, 3, 1000, 3, ARGON2I, 300)
+    assert addresses[0].readonly and len(addresses[1]) == 300
+    if numpy is not None:
+        set_compression_backend("python" if compression_backend == "numpy" else "numpy")
+        assert address_stream(1, 2, 3, 1000, 3, ARGON2I, 300) == addresses
+        set_compression_backend(default_backends[0])
+
+    # one parameter set holds all its segments, the second hash only hits
+    address_cache_clear()
+    argon2(b'pw', b'saltsalt', 3, 256, 4, threads=1)
+    misses = address_cache_info()['misses']
+    argon2(b'pw2', b'saltsalt', 3, 256, 4, threads=1)
+    info = address_cache_info()
+    assert misses == 3 * 4 * 4 and info['misses'] == misses
+    assert info['hits'] == misses and info['parameter_sets'] == 1
+    assert info['bytes'] == 3 * 4 * 4 * 8 * 16
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+#
+# bench.py: throughput and latency benchmarks.
+#
+# Usage:
+#   python -m cryptocourse.bench aes [--key-sizes 128 192 256] [--max-size 67108864] [--output aes.json]
+#   python -m cryptocourse.bench calibrate --target-ms 500 --max-memory 65536 [--cores 4] [--output host.json]
+#
+# For AES, the benchmark measures AES.encrypt (one block, the reference implementation),
+# TableAES.encrypt (one block, T-tables) and AESModeOfOperation.encrypt for every mode in
+# AESModeOfOperation.modeOfOperation, for every key size and for message sizes from 16 bytes
+# up to --max-size (64 MB by default).
+# The results are printed as JSON, so runs on different commits can be compared.
+#
+# calibrate runs argon2.calibrate: the strongest Argon2 parameters for this machine
+# within a latency target, as a JSON report.
+#
+# No part of this module should be used for cryptography in production.
+# This module is strictly for education purposes.
+#
+import sys
+import json
+import time
+import argparse
+import platform
+import secrets
+
+from cryptocourse import aes
+from cryptocourse import argon2
+from cryptocourse import aesModeOfOperation
+
+# message sizes: 16 bytes, 256 bytes, 4 KB, 64 KB, 1 MB, 16 MB, 64 MB
+MESSAGE_SIZES = [16, 256, 4096, 65536, 1 << 20, 1 << 24, 1 << 26]
+KEY_SIZES = [128, 192, 256]
+
+def measure(function, nbrBytes, minTime=0.2, maxCalls=100000):
+    """Calls function until at least minTime seconds have passed (at least once).
+    Returns a dict with the number of calls, the throughput and the latency per call."""
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while calls == 0 or (elapsed < minTime and calls < maxCalls):
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return dict(calls=calls,
+                seconds=elapsed,
+                mb_per_s=nbrBytes * calls / elapsed / 1e6,
+                latency_us=elapsed / calls * 1e6)
+
+def bench_aes(keySizes=KEY_SIZES, maxSize=MESSAGE_SIZES[-1], minTime=0.2, log=None):
+    """Runs the AES benchmarks, returns a list of result dicts"""
+    results = []
+    moo = aesModeOfOperation.AESModeOfOperation()
+    sizes = [size for size in MESSAGE_SIZES if size <= maxSize]
+    for keyBits in keySizes:
+        key = secrets.token_bytes(keyBits // 8)
+        iv = secrets.token_bytes(16)
+        block = secrets.token_bytes(16)
+        cases = [("AES.encrypt", 16, lambda: aes.AES().encrypt(block, key, len(key))),
+                 ("TableAES.encrypt", 16, lambda: aes.TableAES().encrypt(block, key, len(key)))]
+        for size in sizes:
+            message = secrets.token_bytes(size)
+            for modeName, mode in sorted(moo.modeOfOperation.items(), key=lambda item: item[1]):
+                cases.append(("AESModeOfOperation.encrypt[%s]" % modeName, size,
+                              lambda message=message, mode=mode: moo.encrypt(message, mode, key, len(key), iv)))
+        for name, size, function in cases:
+            result = dict(name=name, key_bits=keyBits, message_bytes=size)
+            result.update(measure(function, size, minTime))
+            results.append(result)
+            if log is not None:
+                log.write("%-40s %3d bits %10d bytes %10.3f MB/s %12.1f us\n" %
+                          (name, keyBits, size, result["mb_per_s"], result["latency_us"]))
+                log.flush()
+    return results
+
+def environment():
+    """Describes where the benchmark ran, to compare results of different runs"""
+    return dict(python=platform.python_version(),
+                implementation=platform.python_implementation(),
+                machine=platform.machine(),
+                platform=platform.platform(),
+                block_engine=aes.blockEngine,
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m cryptocourse.bench",
+                                     description="Throughput and latency benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    parserAES = subparsers.add_parser("aes", help="AES and the AES modes of operation")
+    parserAES.add_argument("--key-sizes", type=int, nargs="+", default=KEY_SIZES, choices=KEY_SIZES,
+                           help="key sizes in bits")
+    parserAES.add_argument("--max-size", type=int, default=MESSAGE_SIZES[-1],
+                           help="largest message size in bytes")
+    parserAES.add_argument("--min-time", type=float, default=0.2,
+                           help="minimum time per measurement in seconds")
+    parserAES.add_argument("--engine", choices=["numpy", "table"],
+                           help="block engine for encrypt_blocks (default: numpy if available)")
+    parserAES.add_argument("--label", default="", help="label stored with the results, e.g. a commit")
+    parserAES.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parserAES.add_argument("--quiet", action="store_true", help="no progress on stderr")
+    parserCalibrate = subparsers.add_parser("calibrate", help="Argon2 parameters for a latency target")
+    parserCalibrate.add_argument("--target-ms", type=float, required=True,
+                                 help="the time one hash may take, in milliseconds")
+    parserCalibrate.add_argument("--max-memory", type=int, required=True,
+                                 help="the largest memory cost, in kibibytes")
+    parserCalibrate.add_argument("--cores", type=int, help="lanes and threads (default: the number of CPUs)")
+    parserCalibrate.add_argument("--label", default="", help="label stored with the report, e.g. a host class")
+    parserCalibrate.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "calibrate":
+        report = dict(benchmark=args.benchmark, label=args.label,
+                      environment=environment(),
+                      results=argon2.calibrate(args.target_ms, args.max_memory, args.cores))
+    else:
+        if args.engine:
+            aes.setBlockEngine(args.engine)
+        results = bench_aes(args.key_sizes, args.max_size, args.min_time,
+                            None if args.quiet else sys.stderr)
+        report = dict(benchmark=args.benchmark, label=args.label,
+                      environment=environment(), results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()